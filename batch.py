@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""Пакетный запуск модели процессора: много заданий (программа, ввод) на всех ядрах.
+
+Манифест -- строки JSON, по заданию в строке:
+
+    {"code": "prob1.json", "input": "in.txt", "limit": 100000}
+
+Поля: `code` -- машинный код (JSON или упакованный формат), `input` -- файл
+ввода или `stdin` -- ввод строкой, необязательные `id`, `engine` (`fast`),
+`data_memory_size` (1000), бюджеты `limit` (1500 инструкций), `ticks`,
+`seconds`. Результаты выводятся строками JSON в порядке заданий.
+"""
+
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import machine
+
+programs = {}  # программы, уже загруженные этим процессом: путь -> программа
+
+
+def load_program(code_file):
+    """Загрузить и предекодировать программу один раз на процесс.
+
+    Модели заданий этой программы делят `program.prepared`: нормализованный
+    образ и скомпилированные блоки готовятся первым заданием процесса.
+    """
+    program = programs.get(code_file)
+    if program is None:
+        if machine.PackedProgram.is_packed(code_file):
+            program = machine.PackedProgram(code_file)
+        else:
+            with open(code_file) as f:
+                program = machine.DecodedProgram(json.load(f))
+        program.image()
+        programs[code_file] = program
+    return program
+
+
+def run_model(program, input_port, job):
+    model = machine.Machine(
+        program,
+        input_port,
+        data_memory_size=job.get("data_memory_size", 1000),
+        engine=job.get("engine", "fast"),
+    )
+    reason, instr_counter, ticks = model.run(
+        instructions=job.get("limit", 1500), ticks=job.get("ticks"), seconds=job.get("seconds")
+    )
+    return {
+        "output": model.output_port.getvalue(),
+        "instr_counter": instr_counter,
+        "ticks": ticks,
+        "reason": reason,
+        "fault": model.fault,
+    }
+
+
+def run_job(numbered_job):
+    index, job = numbered_job
+    result = {"id": job.get("id", index)}
+    try:
+        program = load_program(job["code"])
+        if "input" in job:
+            with open(job["input"], "rb") as file:  # ввод читается по ходу исполнения
+                result.update(run_model(program, machine.InputPort(fd=file.fileno()), job))
+        else:
+            input_tokens = [ord(char) for char in job.get("stdin", "")] + [0]
+            result.update(run_model(program, machine.InputPort(input_tokens), job))
+    except (OSError, ValueError, KeyError, AssertionError) as error:
+        result["error"] = "{}: {}".format(type(error).__name__, error)
+    return result
+
+
+def run_batch(jobs, workers=None):
+    """Исполнить задания и выдавать результаты в их порядке.
+
+    `workers` -- число процессов (по умолчанию -- число ядер); при 1 задания
+    исполняются в текущем процессе.
+    """
+    numbered = list(enumerate(jobs))
+    if workers == 1:
+        yield from map(run_job, numbered)
+        return
+    workers = workers or os.cpu_count() or 1
+    # программа загружается один раз на процесс, поэтому задания идут пачками
+    chunksize = max(1, len(numbered) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(run_job, numbered, chunksize=chunksize)
+
+
+def batch(manifest_file, workers=None):
+    with open(manifest_file) if manifest_file != "-" else sys.stdin as f:
+        jobs = [json.loads(line) for line in f if line.strip()]
+    for result in run_batch(jobs, workers):
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    assert len(sys.argv) in (2, 3), "Wrong arguments: batch.py <manifest_file> [workers]"
+    _, manifest_file, *workers = sys.argv
+    batch(manifest_file, int(workers[0]) if workers else None)
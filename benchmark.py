@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+"""Бенчмарки транслятора и модели процессора.
+
+Программы -- golden-тесты (`golden/*.yml`) и синтетические увеличенные
+варианты: длинный ввод для `cat`, большое `n` для `prob1`, глубокая
+вложенность выражений для транслятора. Измеряются скорость трансляции,
+инструкции модели в секунду для каждой модели исполнения, пиковая память
+(`tracemalloc`, трансляция и начало исполнения) и время запуска `machine.py`. Результат -- JSON; при
+сравнении с сохранённым результатом отмечаются регрессии.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import machine
+import translator
+from ruamel.yaml import YAML
+
+threshold = 0.15  # допустимое ухудшение времени и памяти относительно базового результата
+noise_floor = 0.01  # более короткие замеры времени не сравниваются: в них больше шума, чем сигнала
+# tracemalloc замедляет модель на порядки, поэтому память меряется на трансляции,
+# загрузке и начале исполнения: дальше модель памяти почти не выделяет
+memory_instructions = 10000
+root = Path(__file__).resolve().parent
+
+
+def golden_cases():
+    cases = []
+    for path in sorted((root / "golden").glob("*.yml")):
+        with open(path, encoding="utf-8") as f:
+            golden = YAML(typ="safe").load(f)
+        cases.append({"name": path.stem, "source": golden["in_source"], "stdin": golden["in_stdin"]})
+    return cases
+
+
+def synthetic_cases(scale=1):
+    """Увеличенные программы; `scale` меняет размер входа и число инструкций."""
+    golden = {case["name"]: case for case in golden_cases()}
+    # n ограничено непосредственным операндом (int16) и суммой в int32
+    n = min(5000 * scale, 20000)
+    depth = min(100 * scale, 300)  # трансляция рекурсивна: глубина ограничена стеком Python
+    nested = "(OUT " + "(+ 1 " * depth + "0" + ")" * depth + ")"
+    return [
+        {"name": "cat_long", "source": golden["cat"]["source"], "stdin": "lorem ipsum " * (1000 * scale)},
+        {
+            "name": "prob1_large",
+            "source": golden["prob1"]["source"].replace("(prob1 10)", "(prob1 {})".format(n)),
+            "stdin": "",
+        },
+        {"name": "nested", "source": "(" + nested * (10 * scale) + ")", "stdin": ""},
+    ]
+
+
+def best_of(repeat, function):
+    """Наименьшее время из `repeat` запусков и результат последнего."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def translate(source):
+    tokens = translator.tokenizer(source)
+    return translator.translate(tokens, translator.build_ast(tokens))
+
+
+def simulate(code, stdin, engine, limit=10**9):
+    tokens = [ord(char) for char in stdin] + [0]
+    model = machine.Machine(code, machine.InputPort(tokens), engine=engine)
+    return model.run(instructions=limit)
+
+
+def measure_case(case, engines, repeat):
+    result = {}
+    seconds, code = best_of(repeat, lambda: translate(case["source"]))
+    lines = len(case["source"].split("\n"))
+    result["translate"] = {
+        "seconds": seconds,
+        "source_lines": lines,
+        "instructions": len(code) - 1,
+        "lines_per_second": lines / seconds,
+    }
+    for engine in engines:
+        seconds, run = best_of(repeat, lambda: simulate(code, case["stdin"], engine))
+        result[engine] = {
+            "seconds": seconds,
+            "instructions": run.instructions,
+            "ticks": run.ticks,
+            "instructions_per_second": run.instructions / seconds,
+        }
+    tracemalloc.start()
+    try:
+        simulate(translate(case["source"]), case["stdin"], "fast", memory_instructions)
+        result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def measure_startup(repeat):
+    """Время запуска `machine.py` на программе `hello` (интерпретатор, импорт, загрузка, исполнение)."""
+    case = next(case for case in golden_cases() if case["name"] == "hello")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code_name = os.path.join(tmpdirname, "hello.json")
+        input_name = os.path.join(tmpdirname, "input.txt")
+        translator.write_code(code_name, translate(case["source"]))
+        with open(input_name, "w", encoding="utf-8") as file:
+            file.write(case["stdin"])
+        command = [sys.executable, str(root / "machine.py"), code_name, input_name, "fast"]
+        seconds, _ = best_of(repeat, lambda: subprocess.run(command, check=True, capture_output=True))
+    return seconds
+
+
+def run_benchmarks(scale=1, repeat=3, engines=("signal", "fast", "block")):
+    """Все измерения; модель `signal` запускается только на golden-программах (она медленная)."""
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "startup_seconds": measure_startup(repeat),
+        "cases": {},
+    }
+    logging.disable(logging.CRITICAL)  # журнал эталонной модели не должен попадать в замеры
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for case in golden_cases():
+                results["cases"][case["name"]] = measure_case(case, engines, repeat)
+            for case in synthetic_cases(scale):
+                fast_engines = [engine for engine in engines if engine != "signal"]
+                results["cases"][case["name"]] = measure_case(case, fast_engines, repeat)
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+
+def compare(results, baseline, limit=threshold):
+    """Регрессии относительно `baseline`: списком строк.
+
+    Время и память хуже более чем на `limit` -- регрессия (замеры короче
+    `noise_floor` не сравниваются); число инструкций и тактов должно
+    совпадать точно (иначе изменилась семантика или код).
+    """
+    regressions = []
+
+    def check(path, value, base):
+        if not isinstance(value, dict):
+            message = regression(path[-1], value, base, limit)
+            if message is not None:
+                regressions.append("{}: {}".format(".".join(path), message))
+            return
+        timed = base.get("seconds", noise_floor) >= noise_floor if isinstance(base, dict) else False
+        for key in value:
+            if (key == "seconds" or key.endswith("per_second")) and not timed:
+                continue
+            if isinstance(base, dict) and key in base:
+                check(path + [key], value[key], base[key])
+
+    check([], results, baseline)
+    return regressions
+
+
+def regression(key, value, base, limit):
+    """Описание регрессии замера `key` или None."""
+    if key in ("instructions", "ticks") and value != base:
+        return "{} != {}".format(value, base)
+    if key in ("seconds", "startup_seconds", "peak_memory") and value > base * (1 + limit):
+        return "{:.4g} > {:.4g}".format(value, base)
+    if key.endswith("per_second") and value < base * (1 - limit):
+        return "{:.4g} < {:.4g}".format(value, base)
+    return None
+
+
+def benchmark(result_file, baseline_file=None, scale=1):
+    results = run_benchmarks(scale)
+    with open(result_file, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    for name, case in results["cases"].items():
+        speeds = ", ".join(
+            "{} {:.0f} instr/s".format(engine, case[engine]["instructions_per_second"])
+            for engine in ("signal", "fast", "block")
+            if engine in case
+        )
+        print("{}: translate {:.4f} s, {}".format(name, case["translate"]["seconds"], speeds))
+    print("startup: {:.3f} s".format(results["startup_seconds"]))
+    if baseline_file is None:
+        return True
+    with open(baseline_file, encoding="utf-8") as file:
+        regressions = compare(results, json.load(file))
+    for message in regressions:
+        print("REGRESSION", message)
+    return not regressions
+
+
+if __name__ == "__main__":
+    assert len(sys.argv) in (2, 3, 4), "Wrong arguments: benchmark.py <result_file> [baseline_file] [scale]"
+    _, result_file, *rest = sys.argv
+    ok = benchmark(result_file, rest[0] if rest and rest[0] != "-" else None, int(rest[1]) if len(rest) > 1 else 1)
+    sys.exit(0 if ok else 1)
@@ -3,15 +3,34 @@
 Конфигурационнфе файлы: "golden/*.yml"
 """
 
+import asyncio
 import contextlib
+import copy
 import io
+import json
 import logging
 import os
 import tempfile
 
+import batch
+import benchmark
 import pytest
 import machine
+import pipeline
+import profiler
 import translator
+import vector
+
+
+def compile_golden(source, enabled=(), report=None, source_map=None):
+    """Программа транслятора для исходного текста `source` (без промежуточных файлов)."""
+    tokens = translator.tokenizer(source)
+    return translator.translate(tokens, translator.build_ast(tokens), enabled, report, source_map)
+
+
+def golden_input(text):
+    """Токены ввода модели: коды символов `text` и завершающий 0."""
+    return [ord(char) for char in text] + [0]
 
 
 @pytest.mark.golden_test("golden/*.yml")
@@ -73,3 +92,504 @@ def test_translator_and_machine(golden):
         # Проверяем, что ожидания соответствуют реальности.
         assert debug_output == golden.out["out_dbg"]
         assert stdout.getvalue() == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_engines_agree(golden):
+    """Быстрые модели и пошаговая сверка дают тот же результат, что и эталон."""
+    code = compile_golden(golden["in_source"])
+
+    input_tokens = golden_input(golden["in_stdin"])
+    # 137 -- лимит, обрывающий программы посреди базового блока
+    for limit in (1500, 137):
+        results = {
+            engine: machine.simulation(copy.deepcopy(code), list(input_tokens), 1000, limit, engine=engine)
+            for engine in ("signal", "fast", "block", "lockstep")
+        }
+        assert results["fast"] == results["signal"]
+        assert results["block"] == results["signal"]
+        assert results["lockstep"] == results["signal"]
+
+
+def test_engines_agree_on_fault():
+    """Сбой посреди базового блока: вывод и счётчики совпадают с эталоном."""
+    source = """((defvar a 65) (defvar b 0)
+    (while (!= a 70) (OUT a) (setq a (+ a 1)) (setq b (- b 1)) (if (= b -2) (setq b (/ a 0)))))"""
+    code = compile_golden(source)
+    results = {
+        engine: machine.simulation(copy.deepcopy(code), [0], 1000, 1500, engine=engine)
+        for engine in ("signal", "fast", "block", "lockstep")
+    }
+    assert results["signal"][0] == "AB"
+    assert results["fast"] == results["signal"]
+    assert results["block"] == results["signal"]
+    assert results["lockstep"] == results["signal"]
+
+
+def test_memory_manager_wrapping():
+    """Адреса берутся по модулю размера памяти, в том числе для массовых операций."""
+    for size in (8, 10):
+        mm = machine.MemoryManager(size)
+        mm.load(size - 2, [1, 2, 3, 2**31])
+        assert mm.read(-2, 4) == [1, 2, 3, -(2**31)]
+        assert mm.getmem(size) == 3
+        mm.setmem(-1, 7)
+        assert mm.read(0, size)[-3:] == [0, 1, 7]
+
+
+def test_output_port_chunks():
+    """Вывод с `sink` уходит блоками по `chunk_size`, в режиме `raw` -- младшими байтами."""
+    chunks = []
+    port = machine.OutputPort(sink=chunks.append, chunk_size=2, raw=True)
+    for symbol in "Hello":
+        port.write(ord(symbol) + 0x100)
+    assert chunks == [b"He", b"ll"]
+    port.flush()
+    assert chunks == [b"He", b"ll", b"o"]
+    assert port.count() == 5
+    assert port.getvalue() == b""
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_binary_trace_decodes_to_log(golden):
+    """Декодированная двоичная трасса совпадает с журналом DEBUG эталонной модели."""
+    code = compile_golden(golden["in_source"])
+
+    expected = [line for line in golden.out["out_dbg"].splitlines() if line.startswith("DEBUG:")]
+    input_tokens = golden_input(golden["in_stdin"])
+    for engine in ("signal", "fast", "block"):
+        trace = machine.TraceBuffer(capacity=len(expected) + 1)
+        machine.simulation(code, list(input_tokens), 1000, 1500, engine=engine, trace=trace)
+        assert list(machine.decode_trace(trace, machine.split_data_segment(code)[1])) == expected
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_perf_counters(golden):
+    """Счётчики производительности согласованы с итогами эталонной модели."""
+    code = compile_golden(golden["in_source"])
+    input_tokens = golden_input(golden["in_stdin"])
+    counters = machine.PerfCounters()
+    output, instr_counter, ticks = machine.simulation(code, input_tokens, 1000, 1500, counters=counters)
+    report = json.loads(json.dumps(counters.to_dict()))
+
+    assert sum(report["instructions"].values()) == instr_counter
+    assert sum(report["ip_hits"].values()) == instr_counter
+    assert sum(report["ticks"].values()) <= ticks
+    assert report["io"]["out"] == len(output)
+    for ip, outcome in report["branches"].items():
+        assert outcome["taken"] + outcome["not_taken"] == report["ip_hits"][ip]
+    assert report["memory"]["reads"] > 0
+    assert report["stack_depth_max"] > 0
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_data_cache(golden):
+    """Кэш данных меняет только такты: задержка -- по обращениям к памяти."""
+    code = compile_golden(golden["in_source"])
+    input_tokens = golden_input(golden["in_stdin"])
+    output, instr_counter, ticks = machine.simulation(code, list(input_tokens), 1000, 1500)
+
+    for config in ({}, {"policy": "fifo", "size": 16, "ways": 1}, {"policy": "random", "size": 32, "line_size": 2}):
+        cache = machine.DataCache(**config)
+        assert machine.simulation(code, list(input_tokens), 1000, 1500, cache=cache)[:2] == (output, instr_counter)
+        report = cache.to_dict()
+        assert report["reads"] + report["writes"] > 0
+        expected = ticks + cache.miss_ticks * (report["read_misses"] + report["write_misses"] + report["writebacks"])
+        assert (
+            machine.simulation(code, list(input_tokens), 1000, 1500, cache=machine.DataCache(**config))[2] == expected
+        )
+
+    cache = machine.DataCache(write_back=False, miss_ticks=3)
+    assert machine.simulation(code, list(input_tokens), 1000, 1500, cache=cache)[2] == ticks + 3 * (
+        cache.misses[0] + cache.accesses[1]
+    )
+    for engine in ("fast", "block", "lockstep"):  # кэш моделируется только в потактовой модели
+        with pytest.raises(AssertionError, match="Data cache model needs the signal engine"):
+            machine.simulation(code, list(input_tokens), 1000, 1500, engine, cache=machine.DataCache())
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_pipeline_model(golden):
+    """Разбивка CPI конвейерной модели складывается в общее число тактов."""
+    code = compile_golden(golden["in_source"])
+    input_tokens = golden_input(golden["in_stdin"])
+    cycles = {}
+    for predictor in pipeline.predictors:
+        for forwarding in (True, False):
+            result, run = pipeline.simulate(code, machine.InputPort(list(input_tokens)), predictor, forwarding)
+            report = result.to_dict()
+            assert report["instructions"] == run.instructions
+            breakdown = report["breakdown"]
+            cpi = sum(breakdown["data"].values()) + sum(v for v in breakdown.values() if not isinstance(v, dict))
+            assert cpi == pytest.approx(report["cpi"])
+            assert breakdown["fill"] * run.instructions >= 3
+            cycles[predictor, forwarding] = report["cycles"]
+        assert cycles[predictor, True] <= cycles[predictor, False]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_vector_lanes(golden):
+    """Каждая дорожка векторной модели совпадает с отдельным запуском `simulation`."""
+    pytest.importorskip("numpy")
+    code = compile_golden(golden["in_source"])
+    inputs = [golden["in_stdin"], "", "x", "Lorem ipsum\n", golden["in_stdin"] * 3]
+    for limit in (1500, 137):
+        expected = [machine.simulation(code, golden_input(text), 1000, limit, engine="fast") for text in inputs]
+        assert vector.simulate_lanes(code, inputs, limit=limit) == expected
+
+
+@pytest.mark.golden_test("golden/cat.yml")
+def test_async_ports(golden):
+    """Модели на асинхронных каналах ждут ввода и дают тот же результат, что и обычный запуск."""
+    code = compile_golden(golden["in_source"])
+    texts = ["line {}\n".format(i) * i for i in range(10)]
+
+    async def session(text, engine):
+        source, sink = machine.QueuePipe(), machine.QueuePipe()
+        model = machine.Machine(code, machine.InputPort(), engine=engine)
+        task = asyncio.create_task(model.run_async(source, sink, 10**5))
+        data = text.encode("utf-8")
+        for i in range(0, len(data), 4):  # ввод приходит частями, пока модель работает
+            source.write(data[i : i + 4])
+            await asyncio.sleep(0)
+        source.close()
+        run = await task
+        sink.close()
+        output = b""
+        chunk = await sink.read()
+        while chunk:
+            output, chunk = output + chunk, await sink.read()
+        return output.decode("utf-8"), run.instructions, run.ticks
+
+    async def sessions(engine):
+        return await asyncio.gather(*(session(text, engine) for text in texts))
+
+    expected = [machine.simulation(code, golden_input(text), 1000, 10**5) for text in texts]
+    for engine in ("signal", "fast", "block"):
+        assert asyncio.run(sessions(engine)) == expected
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_paged_memory(golden):
+    """Разреженная память на 2**32 слов: тот же результат, выделены только затронутые страницы."""
+    code = compile_golden(golden["in_source"])
+    input_tokens = golden_input(golden["in_stdin"])
+    expected = machine.simulation(code, list(input_tokens), 1000, 1500, engine="fast")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for engine in ("signal", "fast", "block"):
+            for path in (None, os.path.join(tmpdirname, engine + ".mem")):
+                memory = machine.PagedMemory(1 << 32, page_size=256, path=path)
+                result = machine.simulation(code, list(input_tokens), 1000, 1500, engine=engine, memory=memory)
+                assert result == expected
+                assert memory.resident_pages() <= 2  # данные в начале, стек в конце адресного пространства
+                memory.close()
+
+        # образ в файле: слова, которых модель не касалась, читаются без выделения и попадают в снимок
+        image_name, other_name = os.path.join(tmpdirname, "image.mem"), os.path.join(tmpdirname, "other.mem")
+        for name, address in ((image_name, 1 << 31), (other_name, 1 << 30)):
+            memory = machine.PagedMemory(1 << 32, page_size=256, path=name)
+            memory.setmem(address, 77)
+            memory.close()
+        image = machine.PagedMemory(1 << 32, page_size=256, path=image_name)
+        model = machine.Machine(code, machine.InputPort(list(input_tokens)), memory=image)
+        model.run(instructions=100)
+        assert image.getmem(1 << 31) == 77
+        assert image.resident_pages() <= 2
+        for memory in (machine.PagedMemory(), machine.PagedMemory(1 << 32, page_size=256, path=other_name)):
+            restored = machine.Machine(code, machine.InputPort(list(input_tokens)), memory=memory)
+            restored.restore(model.checkpoint())
+            assert memory.getmem(1 << 31) == 77
+            assert memory.getmem(1 << 30) == 0
+            assert restored.run(instructions=1400) == model.run(instructions=1400)
+            model.restore(restored.checkpoint())
+            memory.close()
+        image.close()
+
+    model = machine.Machine(code, machine.InputPort(list(input_tokens)), memory=machine.PagedMemory())
+    model.run(instructions=100)
+    restored = machine.Machine(code, machine.InputPort(list(input_tokens)), memory=machine.PagedMemory())
+    restored.restore(model.checkpoint())
+    assert restored.run(instructions=1400) == model.run(instructions=1400)
+    assert restored.memory_manager.read(-50, 100) == model.memory_manager.read(-50, 100)
+
+    # снимки `MemoryManager` и `PagedMemory` разного формата: контрольная точка другой памяти отвергается
+    for memory, other in ((machine.PagedMemory(1000, page_size=256), None), (None, machine.PagedMemory(1000))):
+        model = machine.Machine(code, machine.InputPort(list(input_tokens)), memory=memory)
+        model.run(instructions=100)
+        restored = machine.Machine(code, machine.InputPort(list(input_tokens)), memory=other)
+        restored.memory_manager.write(0, [1, 2, 3])
+        with pytest.raises(AssertionError, match="Data memory kind mismatch"):
+            restored.restore(model.checkpoint())
+        assert restored.memory_manager.read(0, 3) == [1, 2, 3]
+        assert len(restored.memory_manager.memory) == 1000
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_source_map_profile(golden):
+    """Профиль по карте исходного кода покрывает все такты исполнения."""
+    source_map = {}
+    code = compile_golden(golden["in_source"], source_map=source_map)
+    translator.locate_source(source_map, golden["in_source"])
+    assert len(source_map["instructions"]) == len(code) - 1
+    assert code == compile_golden(golden["in_source"])  # карта не меняет код
+
+    input_tokens = golden_input(golden["in_stdin"])
+    result, run = profiler.profile(code, source_map, machine.InputPort(input_tokens), chunk=100)
+    report = result.to_dict()
+    assert run.ticks - report["ticks"] <= 1  # HALT не попадает в трассу
+    assert sum(function["exclusive"] for function in report["functions"].values()) == report["ticks"]
+    assert report["functions"]["main"]["inclusive"] == report["ticks"]
+    assert sum(report["lines"].values()) == report["ticks"]
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in result.collapsed()) == report["ticks"]
+    for function in source_map["functions"]:
+        assert report["functions"][function["name"]]["calls"] > 0
+
+
+@pytest.mark.golden_test("golden/cat.yml")
+def test_machine_budgets_and_resume(golden):
+    """Исполнение порциями и после нехватки ввода даёт тот же результат, что и за один раз."""
+    code = compile_golden(golden["in_source"])
+
+    tokens = golden_input(golden["in_stdin"])
+    expected = machine.Machine(code, machine.InputPort(tokens)).run()
+    assert expected.reason == machine.StopReasons.HALTED
+
+    for engine in ("signal", "fast", "block"):
+        input_port = machine.InputPort(tokens[:2])
+        model = machine.Machine(code, input_port, engine=engine)
+        assert model.run(instructions=7).reason == machine.StopReasons.INSTRUCTIONS
+        assert model.run(ticks=50).reason == machine.StopReasons.TICKS
+        assert model.run().reason == machine.StopReasons.INPUT_STARVED
+        assert model.run().reason == machine.StopReasons.INPUT_STARVED
+        restored = machine.Machine(code, machine.InputPort(tokens), engine="signal")
+        restored.restore(model.checkpoint())  # ожидание ввода переживает контрольную точку
+        assert restored.run() == expected
+        input_port.buffer.extend(tokens[2:])
+        result = model.run(seconds=60)
+        assert result.reason == machine.StopReasons.HALTED
+        assert model.output_port.getvalue() == golden["in_stdin"]
+        assert result.instructions == expected.instructions
+        # такт выборки IN учитывается один раз, сколько бы она ни ждала ввода
+        assert result.ticks == expected.ticks
+        assert model.run() == result
+
+
+@pytest.mark.golden_test("golden/cat.yml")
+def test_machine_tick_budget(golden):
+    """Порция не выходит за бюджет тактов, в том числе с задержками кэша."""
+    code = compile_golden(golden["in_source"])
+
+    tokens = golden_input(golden["in_stdin"])
+    for engine, cache in (("signal", None), ("fast", None), ("block", None), ("signal", machine.DataCache())):
+        expected = machine.Machine(code, machine.InputPort(tokens), engine=engine, cache=copy.deepcopy(cache)).run()
+        model = machine.Machine(code, machine.InputPort(tokens), engine=engine, cache=cache)
+        result = model.run(ticks=3)
+        assert result.reason == machine.StopReasons.TICKS
+        assert result.ticks <= 3
+        result = model.run(ticks=10)
+        assert result.ticks <= 13
+        while result.reason == machine.StopReasons.TICKS:
+            ticks = result.ticks
+            result = model.run(ticks=model.max_instruction_ticks)
+            assert ticks < result.ticks <= ticks + model.max_instruction_ticks
+        assert result == expected
+
+
+@pytest.mark.golden_test("golden/hello_user_name.yml")
+def test_checkpoint_restore(golden):
+    """Модель, восстановленная из контрольной точки, продолжает работу так же, как исходная."""
+    code = compile_golden(golden["in_source"])
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        checkpoint_name = os.path.join(tmpdirname, "target.chk")
+        tokens = golden_input(golden["in_stdin"])
+        expected = machine.Machine(code, machine.InputPort(tokens)).run()
+
+        warm = machine.Machine(code, machine.InputPort(tokens), engine="block")
+        warm.run(instructions=700)
+        warm.save(checkpoint_name)
+        prefix = warm.output_port.getvalue()
+        for engine in ("signal", "fast", "block"):
+            model = machine.Machine(code, machine.InputPort(tokens), engine=engine)
+            model.load(checkpoint_name)
+            assert model.run() == expected
+            assert prefix + model.output_port.getvalue() == "What is your name?\nHello, Alice!"
+
+    memory = machine.MemoryManager(1000)
+    memory.write(0, [1, 2, 3])
+    for size in (999, 1001):  # снимок другой памяти отвергается до изменения
+        with pytest.raises(AssertionError, match="Memory snapshot size mismatch"):
+            memory.restore_snapshot(machine.MemoryManager(size).snapshot())
+    assert memory.read(0, 3) == [1, 2, 3]
+    assert len(memory.memory) == 1000
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_packed_program(golden):
+    """Программа в упакованном двоичном формате исполняется так же, как JSON."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_name = os.path.join(tmpdirname, "source.lsp")
+        input_name = os.path.join(tmpdirname, "input.txt")
+        target_name = os.path.join(tmpdirname, "target.bin")
+        debug_name = os.path.join(tmpdirname, "target.dbg")
+        with open(source_name, "w", encoding="utf-8") as file:
+            file.write(golden["in_source"])
+        with open(input_name, "w", encoding="utf-8") as file:
+            file.write(golden["in_stdin"])
+
+        logging.getLogger().setLevel(logging.DEBUG)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            translator.translate_code(source_name, target_name)
+            print("============================================================")
+            machine.machine(target_name, input_name, debug_name)
+        with open(debug_name, encoding="utf-8") as file:
+            debug_output = file.read()
+
+        assert machine.PackedProgram.is_packed(target_name)
+        assert debug_output == golden.out["out_dbg"]
+        assert stdout.getvalue() == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+@pytest.mark.parametrize("enabled", [("peephole",), ("acc",), ("acc", "peephole")])
+def test_optimizations(golden, enabled):
+    """Оптимизации не меняют вывод и уменьшают число инструкций и тактов."""
+    code = compile_golden(golden["in_source"])
+    report = {}
+    optimized = compile_golden(golden["in_source"], enabled, report)
+
+    if "peephole" in enabled:
+        instructions, ticks = report["peephole"]
+        assert instructions > 0
+        assert ticks > 0
+    input_tokens = golden_input(golden["in_stdin"])
+    output, instr_counter, tick_counter = machine.simulation(code, input_tokens, 1000, 1500, engine="fast")
+    result = machine.simulation(optimized, input_tokens, 1000, 1500, engine="lockstep")
+    assert result[0] == output
+    assert result[1] < instr_counter
+    assert result[2] < tick_counter
+
+
+def test_constant_folding():
+    """Свёртка констант по правилам АЛУ и удаление невызываемых функций и ложных ветвей."""
+    source = """((defvar x 3)
+    (defun unused (a) (OUT "never") a)
+    (defun twice (a) (* a 2))
+    (if 0 (unused 1))
+    (while (!= 2 2) (OUT 67))
+    (OUT (+ 48 (% -7 10)))
+    (OUT (+ 48 (/ -7 2)))
+    (OUT (+ 48 (/ (* 1000 1000) 100000)))
+    (OUT (+ 48 (>= 7 (- 100000 1))))
+    (if (= 1 1) (OUT (+ x (twice 10)))))"""
+    code = compile_golden(source)
+    folded = compile_golden(source, ("fold",))
+
+    assert len(folded) < len(code)
+    assert len(folded[0]) < len(code[0])
+    output = machine.simulation(code, [0], 1000, 1500, engine="fast")[0]
+    assert machine.simulation(folded, [0], 1000, 1500, engine="lockstep")[0] == output
+
+
+@pytest.mark.parametrize(
+    ("source", "output"),
+    [
+        ("((defun f (a) (OUT a)) (f 65))", "A"),
+        ("((if 0 (defvar x 1)) (setq x 66) (OUT x))", "B"),
+        ("((while 0 (defun g (a) a)) (OUT (g 67)))", "C"),
+    ],
+)
+def test_folding_keeps_definitions(source, output):
+    """Свёртка не удаляет вызываемые функции и определения в ложных ветвях."""
+    for enabled in ((), ("fold",)):
+        code = compile_golden(source, enabled)
+        assert machine.simulation(code, [0], 1000, 1500, engine="lockstep")[0] == output
+
+
+@pytest.mark.parametrize("enabled", [("tco",), ("fold", "acc", "tco", "peephole")])
+def test_tail_calls(enabled):
+    """Хвостовая рекурсия исполняется в постоянном стеке: глубина больше памяти данных."""
+    source = """((defun twice (n) (* n 2))
+    (defun countdown (n) (OUT (+ 48 (% n 10))) (if (!= n 0) (countdown (- n 1))))
+    (defun next (n) (twice (+ n 1)))
+    (countdown 1200)
+    (OUT (+ 48 (next 2))))"""
+    code = compile_golden(source, enabled)
+
+    assert sum(instr["instruction"] == "CALL" for instr in code[1:]) == 2  # только вызовы из корня
+    output = machine.simulation(code, [0], 1000, 10**6, engine="lockstep")[0]
+    assert output == "0987654321" * 120 + "06"
+
+
+@pytest.mark.golden_test("golden/hello.yml")
+def test_compile_cache(golden):
+    """Повторная трансляция берётся из кэша с тем же результатом; старые записи вытесняются."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_name = os.path.join(tmpdirname, "source.lsp")
+        with open(source_name, "w", encoding="utf-8") as file:
+            file.write(golden["in_source"])
+        cache = translator.CompileCache(os.path.join(tmpdirname, "cache"))
+        outputs = []
+        for target in ("first.json", "second.json"):
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                translator.translate_code(source_name, os.path.join(tmpdirname, target), (), cache)
+            with open(os.path.join(tmpdirname, target), encoding="utf-8") as file:
+                outputs.append((stdout.getvalue(), file.read()))
+        assert outputs[0] == outputs[1]
+        assert len(list(os.scandir(cache.path))) == 1
+
+        cache.max_bytes = 1
+        with contextlib.redirect_stdout(io.StringIO()):
+            translator.translate_code(source_name, os.path.join(tmpdirname, "third.bin"), ("peephole",), cache)
+        assert len(list(os.scandir(cache.path))) == 0
+
+
+@pytest.mark.golden_test("golden/cat.yml")
+def test_batch(golden):
+    """Пакетный запуск на нескольких процессах совпадает с одиночными запусками."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_name = os.path.join(tmpdirname, "source.lsp")
+        input_name = os.path.join(tmpdirname, "input.txt")
+        target_name = os.path.join(tmpdirname, "target.asm")
+        with open(source_name, "w", encoding="utf-8") as file:
+            file.write(golden["in_source"])
+        with open(input_name, "w", encoding="utf-8") as file:
+            file.write(golden["in_stdin"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            translator.translate_code(source_name, target_name)
+        code = compile_golden(golden["in_source"])
+
+        texts = ["", "a", "batch", golden["in_stdin"]]
+        jobs = [{"code": target_name, "stdin": text} for text in texts]
+        jobs += [{"code": target_name, "input": input_name, "limit": 5, "id": "file"}, {"code": "missing.asm"}]
+        results = list(batch.run_batch(jobs, workers=2))
+
+        program = batch.load_program(target_name)
+        first, second = (machine.Machine(program, machine.InputPort([0]), engine="block") for _ in range(2))
+        first.run()
+        assert second.engine.blocks is first.engine.blocks  # блоки компилируются один раз на программу
+        assert second.run() == first.run()
+
+    for text, result in zip(texts, results):
+        output, instr_counter, ticks = machine.simulation(code, golden_input(text), 1000, 1500, "fast")
+        assert (result["output"], result["instr_counter"], result["ticks"]) == (output, instr_counter, ticks)
+        assert result["reason"] == machine.StopReasons.HALTED
+    assert results[4]["id"] == "file"
+    assert results[4]["reason"] == machine.StopReasons.INSTRUCTIONS
+    assert "error" in results[5]
+
+
+def test_benchmark_compare():
+    """Синтетические бенчмарки исполняются одинаково всеми моделями; сравнение находит регрессии."""
+    results = {"cases": {}}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for case in benchmark.synthetic_cases():
+            results["cases"][case["name"]] = benchmark.measure_case(case, ("fast", "block"), repeat=1)
+    for case in results["cases"].values():
+        assert case["fast"]["instructions"] == case["block"]["instructions"] > 0
+        assert case["fast"]["ticks"] == case["block"]["ticks"]
+    assert benchmark.compare(results, results) == []
+
+    slower = copy.deepcopy(results)
+    slower["cases"]["prob1_large"]["fast"]["seconds"] = 2 * results["cases"]["prob1_large"]["fast"]["seconds"] + 1
+    slower["cases"]["cat_long"]["block"]["ticks"] += 1
+    assert len(benchmark.compare(slower, results)) == 2
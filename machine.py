@@ -1,6 +1,21 @@
 #!/usr/bin/python3
+import asyncio
+import codecs
+import errno
+import hashlib
+import io
+import json
 import logging
+import mmap
+import os
+import random
+import re
+import struct
 import sys
+import time
+import zlib
+from array import array
+from collections import Counter, deque, namedtuple
 
 
 def mod_in_ring(number, n):
@@ -33,15 +48,413 @@ def crop_int_to_uint16(num):
 
 
 class MemoryManager:
+    """
+    Память данных: `size` 32-битных ячеек в `array("i")` (4 байта на слово).
+
+    Адрес берётся по модулю `size`; для размеров -- степеней двойки вместо
+    деления используется маска `size - 1`.
+    """
+
     def __init__(self, size):
-        self.memory = [0] * size
+        assert size > 0, "Memory size must be positive"
+        self.memory = array("i", bytes(4 * size))
+        self.size = size
+        self.mask = size - 1 if size & (size - 1) == 0 else None
+
+    def wrap(self, address):
+        return address & self.mask if self.mask is not None else address % self.size
+
+    def setmem(self, address, value):
+        self.memory[address & self.mask if self.mask is not None else address % self.size] = value
+
+    def getmem(self, address):
+        return self.memory[address & self.mask if self.mask is not None else address % self.size]
+
+    def load(self, address, values):
+        """Записать `values` подряд, начиная с `address` (значения обрезаются до int32)."""
+        self.write(address, [crop_int_to_int32(value) for value in values])
+
+    def write(self, address, values):
+        start = self.wrap(address)
+        if start + len(values) <= self.size:
+            self.memory[start : start + len(values)] = array("i", values)
+        else:
+            for i, value in enumerate(values):
+                self.setmem(address + i, value)
+
+    def read(self, address, count):
+        start = self.wrap(address)
+        if start + count <= self.size:
+            return self.memory[start : start + count].tolist()
+        return [self.getmem(address + i) for i in range(count)]
+
+    snapshot_kind = 0  # формат `snapshot`, записывается в заголовок контрольной точки
+
+    def snapshot(self):
+        """Содержимое памяти для `Machine.checkpoint` (сжато zlib)."""
+        return zlib.compress(self.memory.tobytes(), 1)
+
+    def restore_snapshot(self, data):
+        data = zlib.decompress(data)
+        assert len(data) == 4 * self.size, "Memory snapshot size mismatch"
+        self.memory[:] = array("i", data)
+
+
+class PagedMemory(MemoryManager):
+    """
+    Разреженная память данных: страницы по `page_size` слов.
+
+    Страница выделяется при первой записи значения, отличного от текущего
+    (без файла -- ненулевого), чтение нетронутой страницы страницу не
+    выделяет, поэтому адресное пространство до 2**32 слов (стек в конце,
+    данные в начале, разреженная куча) занимает память только под
+    затронутые записью страницы. Таблица страниц -- словарь номер ->
+    `array("i")`.
+
+    С `path` память -- отображённый в память файл на `size` слов (файл
+    создаётся разреженным, существующий используется как образ памяти):
+    чтение идёт прямо из отображения, страницы -- окна в него, записи
+    попадают в файл. Это позволяет работать с образами больше ОЗУ.
+
+    Модели исполнения обращаются к `memory[адрес]` напрямую: здесь это сама
+    таблица страниц (`__getitem__`/`__setitem__`), медленнее, чем `array`.
+    """
+
+    snapshot_kind = 1
+
+    def __init__(self, size=1 << 32, page_size=1 << 12, path=None):
+        assert 0 < size <= 1 << 32, "Memory size must be in 1..2**32 words"
+        assert page_size > 0, "Page size must be a power of two"
+        assert page_size & (page_size - 1) == 0, "Page size must be a power of two"
         self.size = size
+        self.mask = size - 1 if size & (size - 1) == 0 else None
+        self.page_size = page_size
+        self.page_bits = page_size.bit_length() - 1
+        self.offset_mask = page_size - 1
+        self.pages = {}
+        self.memory = self
+        self.file = self.map = self.view = None
+        if path is not None:
+            self.file = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), "r+b")
+            if os.fstat(self.file.fileno()).st_size < 4 * size:
+                self.file.truncate(4 * size)
+            self.map = mmap.mmap(self.file.fileno(), 4 * size)
+            self.view = memoryview(self.map).cast("i")
+
+    def page(self, number):
+        """Страница `number`, выделяемая при первом обращении."""
+        page = self.pages.get(number)
+        if page is None:
+            start = number << self.page_bits
+            if self.view is not None:
+                page = self.view[start : start + self.page_size]
+            else:
+                page = array("i", bytes(4 * min(self.page_size, self.size - start)))
+            self.pages[number] = page
+        return page
+
+    def __getitem__(self, index):
+        page = self.pages.get(index >> self.page_bits)
+        if page is None:
+            return 0 if self.view is None else self.view[index]
+        return page[index & self.offset_mask]
+
+    def __setitem__(self, index, value):
+        page = self.pages.get(index >> self.page_bits)
+        if page is None:
+            if value == self[index]:  # ячейка уже хранит это значение -- страница не нужна
+                return
+            page = self.page(index >> self.page_bits)
+        page[index & self.offset_mask] = value
+
+    def __len__(self):
+        return self.size
 
     def setmem(self, address, value):
-        self.memory[mod_in_ring(address, self.size)] = value
+        self[self.wrap(address)] = value
+
+    def getmem(self, address):
+        return self[self.wrap(address)]
+
+    def write(self, address, values):
+        for i, value in enumerate(values):
+            self.setmem(address + i, value)
+
+    def read(self, address, count):
+        return [self.getmem(address + i) for i in range(count)]
+
+    def resident_pages(self):
+        """Число выделенных (затронутых записью) страниц."""
+        return len(self.pages)
+
+    def stored_pages(self):
+        """Номера страниц, которые могут быть ненулевыми, по возрастанию.
+
+        Без файла это выделенные страницы. В файле ненулевыми могут быть и
+        страницы образа, которых модель не касалась: они ищутся по областям
+        данных разреженного файла (`SEEK_DATA`/`SEEK_HOLE`), а если система
+        этого не умеет -- перебираются все.
+        """
+        if self.map is None:
+            return sorted(self.pages)
+        everything = range((self.size + self.page_size - 1) // self.page_size)
+        if not hasattr(os, "SEEK_DATA"):
+            return everything
+        self.map.flush()  # записи через отображение должны стать данными файла
+        page_bytes, end = 4 * self.page_size, 4 * self.size
+        numbers, position = set(self.pages), 0
+        try:
+            while position < end:
+                start = os.lseek(self.file.fileno(), position, os.SEEK_DATA)
+                position = min(os.lseek(self.file.fileno(), start, os.SEEK_HOLE), end)
+                numbers.update(range(start // page_bytes, (position - 1) // page_bytes + 1))
+        except OSError as error:
+            if error.errno != errno.ENXIO:  # ENXIO -- дальше данных нет
+                return everything
+        return sorted(numbers)
+
+    def page_words(self, number):
+        """Слова страницы `number` без её выделения."""
+        if self.view is None:
+            return self.pages[number]
+        start = number << self.page_bits
+        return self.view[start : start + self.page_size]
+
+    def snapshot(self):
+        """Ненулевые страницы: `(адрес u32, число слов u32, слова)...`, сжато zlib.
+
+        Адреса -- в словах, поэтому снимок восстанавливается и в памяти с
+        другим `page_size`.
+        """
+        parts = []
+        for number in self.stored_pages():
+            words = self.page_words(number)
+            data = words.tobytes()
+            if data.count(0) != len(data):
+                parts += [struct.pack("<II", number << self.page_bits, len(words)), data]
+        return zlib.compress(b"".join(parts), 1)
+
+    def restore_snapshot(self, data):
+        data = zlib.decompress(data)
+        for number in self.stored_pages():
+            page = self.page_words(number)
+            page[:] = array("i", bytes(len(page) * 4))
+        position = 0
+        while position < len(data):
+            address, count = struct.unpack_from("<II", data, position)
+            words = array("i", data[position + 8 : position + 8 + 4 * count])
+            for offset, value in enumerate(words):
+                if value:  # остальное уже обнулено
+                    self[address + offset] = value
+            position += 8 + 4 * count
+
+    def close(self):
+        if self.map is not None:
+            self.pages.clear()
+            self.view.release()
+            self.view = None
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+            self.map = self.file = None
+
+
+class DataCache:
+    """
+    Модель кэша данных между `DataPath` и `MemoryManager` (только такты).
+
+    `size` слов, строки по `line_size` слов, `ways`-канальная
+    ассоциативность (размеры -- степени двойки), вытеснение `policy` из
+    `policies`. При `write_back` запись попадает в строку (с выделением
+    строки при промахе), грязная строка при вытеснении пишется в память;
+    иначе запись сквозная без выделения строки и каждая запись идёт в память.
+
+    Данные по-прежнему хранит `MemoryManager`: кэш ведёт только теги и
+    копит задержку `stall` -- `hit_ticks` за попадание и `miss_ticks` за
+    каждое обращение к памяти (промах, сквозная запись, запись грязной
+    строки). Таблица тактов инструкций соответствует кэшу, в котором все
+    обращения -- попадания с `hit_ticks = 0`; `ControlUnit` добавляет
+    накопленную задержку к тактам инструкции.
+    """
+
+    policies = ("lru", "fifo", "random")
+
+    def __init__(
+        self, size=256, line_size=4, ways=2, policy="lru", write_back=True, hit_ticks=0, miss_ticks=10, seed=0
+    ):
+        assert policy in self.policies, "Unknown replacement policy: " + str(policy)
+        assert size > 0, "Cache size must be a power of two"
+        assert size & (size - 1) == 0, "Cache size must be a power of two"
+        assert line_size > 0, "Line size must be a power of two"
+        assert line_size & (line_size - 1) == 0, "Line size must be a power of two"
+        assert ways > 0, "Number of ways must be positive"
+        assert size % (line_size * ways) == 0, "Cache size must be a multiple of line_size * ways"
+        sets = size // (line_size * ways)
+        assert sets & (sets - 1) == 0, "Number of sets must be a power of two"
+        self.size, self.line_size, self.ways, self.policy = size, line_size, ways, policy
+        self.write_back, self.hit_ticks, self.miss_ticks = write_back, hit_ticks, miss_ticks
+        self.line_bits = line_size.bit_length() - 1
+        self.set_mask = sets - 1
+        self.sets = [{} for _ in range(sets)]  # номер строки -> грязная; порядок -- порядок вытеснения
+        self.random = random.Random(seed)
+        self.memory = None
+        self.stall = 0  # задержка, ещё не переданная в такты
+        self.accesses = [0, 0]  # чтения, записи
+        self.misses = [0, 0]
+        self.writebacks = 0
+
+    def attach(self, memory):
+        self.memory = memory
+        return self
+
+    def max_access_ticks(self):
+        """Наибольшая задержка одного обращения: промах с записью грязной строки."""
+        return max(self.hit_ticks, 2 * self.miss_ticks)
+
+    def access(self, address, write):
+        self.accesses[write] += 1
+        line = self.memory.wrap(address) >> self.line_bits
+        ways = self.sets[line & self.set_mask]
+        if line in ways:
+            if self.policy == "lru":
+                ways[line] = ways.pop(line)
+            if write and self.write_back:
+                ways[line] = True
+            self.stall += self.hit_ticks if self.write_back or not write else self.miss_ticks
+            return
+        self.misses[write] += 1
+        self.stall += self.miss_ticks
+        if write and not self.write_back:
+            return
+        if len(ways) >= self.ways:
+            victim = next(iter(ways)) if self.policy != "random" else list(ways)[self.random.randrange(len(ways))]
+            if ways.pop(victim):
+                self.writebacks += 1
+                self.stall += self.miss_ticks
+        ways[line] = write
 
     def getmem(self, address):
-        return self.memory[mod_in_ring(address, self.size)]
+        self.access(address, False)
+        return self.memory.getmem(address)
+
+    def setmem(self, address, value):
+        self.access(address, True)
+        self.memory.setmem(address, value)
+
+    def hit_rate(self):
+        accesses = sum(self.accesses)
+        return (accesses - sum(self.misses)) / accesses if accesses else 1.0
+
+    def to_dict(self):
+        return {
+            "reads": self.accesses[0],
+            "read_misses": self.misses[0],
+            "writes": self.accesses[1],
+            "write_misses": self.misses[1],
+            "writebacks": self.writebacks,
+            "hit_rate": self.hit_rate(),
+        }
+
+
+class InputPort:
+    """
+    Порт ввода: очередь токенов (кодов символов) с чтением за O(1).
+
+    Токены берутся из готовой последовательности `tokens` и/или лениво, блоками
+    по `chunk_size` байт, из файлового дескриптора `fd` (файл, канал, stdin).
+    Байты декодируются как UTF-8 с переводом концов строк в `\\n`, как при
+    чтении текстового файла. При исчерпании дескриптора в порт добавляется
+    завершающий 0. Байты можно подавать и извне (`feed`), например из
+    `asyncio`-потока, см. `Machine.run_async`.
+    """
+
+    def __init__(self, tokens=(), fd=None, chunk_size=1 << 16):
+        self.buffer = deque(tokens)
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(), translate=True)
+        self.consumed = 0
+        self.closed = False  # конец ввода уже получен через `feed`
+
+    def feed(self, chunk):
+        """Добавить байты `chunk`; пустой `chunk` -- конец ввода (завершающий 0)."""
+        self.buffer.extend(map(ord, self.decoder.decode(chunk, final=not chunk)))
+        if not chunk:
+            self.buffer.append(0)
+            self.closed = True
+
+    def fill(self):
+        while not self.buffer and self.fd is not None:
+            chunk = os.read(self.fd, self.chunk_size)
+            self.feed(chunk)
+            if not chunk:
+                self.fd = None
+
+    def read(self):
+        """Следующий токен или `None`, если ввод закончился."""
+        if not self.buffer:
+            self.fill()
+            if not self.buffer:
+                return None
+        self.consumed += 1
+        return self.buffer.popleft()
+
+    def skip(self, count):
+        """Пропустить `count` токенов (например, уже прочитанных до контрольной точки)."""
+        for _ in range(count):
+            if self.read() is None:
+                break
+
+    def __iter__(self):
+        token = self.read()
+        while token is not None:
+            yield token
+            token = self.read()
+
+
+class OutputPort:
+    """
+    Порт вывода.
+
+    Без `sink` вывод накапливается и возвращается `getvalue()`. С `sink`
+    (`sys.stdout.write`, `file.write` или любая функция) вывод передаётся
+    блоками по `chunk_size` символов прямо во время моделирования, и память
+    не растёт. В режиме `raw` в порт пишется младший байт AC (`bytes`) без
+    `chr` и склейки строк.
+    """
+
+    def __init__(self, sink=None, chunk_size=1 << 16, raw=False):
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.raw = raw
+        self.buffer = bytearray() if raw else []
+        self.flushed = 0
+
+    def write(self, value):
+        if self.raw:
+            self.buffer.append(value & 0xFF)
+        else:
+            self.buffer.append(chr(value))
+        if self.sink is not None and len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.sink is not None and self.buffer:
+            self.sink(self.take())
+
+    def take(self):
+        """Забрать накопленный вывод: он считается выведенным, как после `flush`."""
+        value = self.getvalue()
+        self.flushed += len(self.buffer)
+        self.buffer.clear()
+        return value
+
+    def count(self):
+        """Число выведенных символов (байт)."""
+        return self.flushed + len(self.buffer)
+
+    def getvalue(self):
+        return bytes(self.buffer) if self.raw else "".join(self.buffer)
 
 
 class magic_numbers:
@@ -61,6 +474,54 @@ class magic_numbers:
     MUX_S_DEC = 1
 
 
+class Opcodes:
+    NOP = 0
+    HALT = 1
+    LD = 2
+    ST = 3
+    ADD = 4
+    SUB = 5
+    MUL = 6
+    DIV = 7
+    MOD = 8
+    CMP = 9
+    JMP = 10
+    JE = 11
+    JNE = 12
+    JGE = 13
+    CALL = 14
+    RET = 15
+    PUSH = 16
+    POP = 17
+    IN = 18
+    OUT = 19
+
+
+opcode_by_name = {name: getattr(Opcodes, name) for name in dir(Opcodes) if not name.startswith("_")}
+name_by_opcode = {opcode: name for name, opcode in opcode_by_name.items()}
+
+# opcode -> операция АЛУ для арифметических инструкций
+alu_opcodes = {
+    Opcodes.ADD: "ADD",
+    Opcodes.SUB: "SUB",
+    Opcodes.MUL: "MUL",
+    Opcodes.DIV: "DIV",
+    Opcodes.MOD: "MOD",
+    Opcodes.CMP: "CMP",
+}
+
+jump_opcodes = (Opcodes.JMP, Opcodes.JE, Opcodes.JNE, Opcodes.JGE, Opcodes.CALL)
+
+
+class StopReasons:
+    HALTED = "halted"
+    INSTRUCTIONS = "instruction budget exhausted"
+    TICKS = "tick budget exhausted"
+    TIME = "time budget exhausted"
+    INPUT_STARVED = "input starved"
+    FAULT = "fault"
+
+
 class DataPath:
     """
 
@@ -132,8 +593,9 @@ class DataPath:
     alu_flags = None
     input_buffer = None
     output_buffer = None
+    counters = None
 
-    def __init__(self, memory_manager, input_buffer):
+    def __init__(self, memory_manager, input_buffer, output_buffer=None):
         self.memory_manager = memory_manager
         self.rAC = 0
         self.rAR = 0
@@ -141,16 +603,19 @@ class DataPath:
         self.rDR = 0
         self.alu_flags = {"Z": True, "S": False}
         self.input_buffer = input_buffer
-        self.output_buffer = []
+        self.output_buffer = output_buffer if output_buffer is not None else OutputPort()
 
     def signal_latch_ip(self, sel_l, sel_r, alu_op):
         self.rAR = self.alu(sel_l, sel_r, alu_op)
 
     def signal_latch_ac(self, sel_l, sel_r, alu_op, sel_a=magic_numbers.MUX_A_ALU):
         if sel_a == magic_numbers.MUX_A_INP:
-            if len(self.input_buffer) == 0:
+            token = self.input_buffer.read()
+            if token is None:
                 raise EOFError()
-            self.rAC = self.input_buffer.pop(0)
+            self.rAC = token
+            if self.counters is not None:
+                self.counters.inputs += 1
         else:
             self.rAC = self.alu(sel_l, sel_r, alu_op)
 
@@ -165,16 +630,21 @@ class DataPath:
 
     def signal_oe(self):
         self.rDR = self.memory_manager.getmem(self.rAR)
+        if self.counters is not None:
+            self.counters.memory_reads += 1
 
     def signal_wr(self, sel_l, sel_r, alu_op):
         self.memory_manager.setmem(self.rAR, self.alu(sel_l, sel_r, alu_op))
+        if self.counters is not None:
+            self.counters.memory_writes += 1
 
     def signal_malloc(self, sel_l, sel_r, alu_op):
         self.memory_manager.malloc(self.alu(sel_l, sel_r, alu_op))
 
     def signal_out(self):
-        symbol = chr(self.rAC)
-        self.output_buffer.append(symbol)
+        self.output_buffer.write(self.rAC)
+        if self.counters is not None:
+            self.counters.outputs += 1
 
     def zero(self):
         return self.alu_flags["Z"]
@@ -270,6 +740,194 @@ class DataPath:
 """
 
 
+def decode_value(s):
+    if re.search(r"^-?[0-9]+$", s):
+        return (0, crop_int_to_int16(int(s)))
+    if re.search(r"^\[-?[0-9]+\]$", s):
+        return (1, crop_int_to_int16(int(s[1:-1])))
+    if re.search(r"^SP[-+][0-9]+$", s):
+        return (2, crop_int_to_int16(int(s[2:])))
+    if re.search(r"^\[SP[-+][0-9]+\]$", s):
+        return (3, crop_int_to_int16(int(s[3:-1])))
+    return None
+
+
+def decode_program(programm):
+    """Предекодирование программы при загрузке.
+
+    Каждая инструкция превращается в кортеж `(opcode, F, V)`: номер операции,
+    режим адресации и 16-битное значение операнда. Для инструкций перехода `V`
+    берётся из поля `V` (адрес после линковки). Неизвестные инструкции
+    исполняются как `NOP`, неразрешённые метки переходов отвергаются.
+    """
+    image = []
+    for instr in programm:
+        opcode = opcode_by_name.get(instr["instruction"], Opcodes.NOP)
+        mode, value = None, instr.get("V")
+        if "operand" in instr:
+            decoded = decode_value(instr["operand"])
+            assert decoded is not None, "Invalid operand"
+            mode, value = decoded
+        if opcode in jump_opcodes:
+            assert isinstance(value, int), "Unresolved label"
+        image.append((opcode, mode, value))
+    return image
+
+
+# Упакованный двоичный формат программы: заголовок, сегмент данных (int32)
+# и по одному 32-битному слову на инструкцию. Все числа little-endian.
+#
+#     биты 24..31  opcode
+#     бит  18      у инструкции есть операнд
+#     биты 16..17  режим адресации F
+#     биты 0..15   V: int16 для операнда, адрес для перехода
+packed_header = struct.Struct("<4sHHII")  # magic, version, flags, data words, code words
+packed_magic = b"CSA1"
+packed_version = 1
+
+
+def encode_instruction(opcode, mode, value):
+    word = opcode << 24
+    if mode is not None:
+        word |= 1 << 18 | mode << 16 | value & 0xFFFF
+    elif value is not None:
+        assert 0 <= value <= 0xFFFF, "Jump target does not fit in 16 bits"
+        word |= value
+    return word
+
+
+def decode_instruction(word):
+    opcode = word >> 24
+    if word & 1 << 18:
+        return opcode, word >> 16 & 3, crop_int_to_int16(word & 0xFFFF)
+    if opcode in jump_opcodes:
+        return opcode, None, word & 0xFFFF
+    return opcode, None, None
+
+
+def format_operand(mode, value):
+    return ("{}", "[{}]", "SP{:+d}", "[SP{:+d}]")[mode].format(value)
+
+
+def instruction_from_image(opcode, mode, value):
+    """Восстановить инструкцию в виде словаря, как её выдаёт транслятор."""
+    instr = {"instruction": name_by_opcode[opcode]}
+    if mode is not None:
+        instr["operand"] = format_operand(mode, value)
+    elif value is not None:
+        instr["V"] = value
+    return instr
+
+
+def write_packed(file_path, code):
+    """Записать программу (JSON-представление транслятора) в упакованном формате."""
+    data, programm = split_data_segment(code)
+    data = array("i", (crop_int_to_int32(value) for value in data))
+    words = array("I", (encode_instruction(*instr) for instr in decode_program(programm)))
+    if sys.byteorder == "big":
+        data.byteswap()
+        words.byteswap()
+    with open(file_path, "wb") as file:
+        file.write(packed_header.pack(packed_magic, packed_version, 0, len(data), len(words)))
+        file.write(data.tobytes())
+        file.write(words.tobytes())
+
+
+class DecodedProgram:
+    """Программа (JSON-представление транслятора), предекодированная один раз для многих `Machine`."""
+
+    def __init__(self, code):
+        self.data, self.programm = split_data_segment(code)
+        self._image = decode_program(self.programm)
+        self.prepared = {}  # общее для моделей этой программы, см. `FastEngine`
+
+    def __len__(self):
+        return len(self.programm)
+
+    def image(self):
+        return self._image
+
+    def instructions(self):
+        return self.programm
+
+
+class PackedProgram:
+    """
+    Программа, загруженная из упакованного файла.
+
+    Файл отображается в память, слова инструкций читаются через `memoryview`
+    без разбора текста и копирования: открытие не зависит от размера
+    программы. Предекодированный образ, который индексируют модели, строится
+    при первом `image()` одним проходом по словам (O(n), но без разбора
+    JSON); словари инструкций нужны только эталонной модели и журналу.
+    """
+
+    def __init__(self, file_path):
+        with open(file_path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, data_size, code_size = packed_header.unpack_from(self.buffer)
+        assert magic == packed_magic, "Not a packed program"
+        assert version == packed_version, "Unsupported packed program version"
+        start = packed_header.size
+        view = memoryview(self.buffer)
+        data = view[start : start + 4 * data_size]
+        words = view[start + 4 * data_size : start + 4 * (data_size + code_size)]
+        if sys.byteorder == "big":
+            data, words = array("i", data), array("I", words)
+            data.byteswap()
+            words.byteswap()
+        else:
+            data, words = data.cast("i"), words.cast("I")
+        self.data = data
+        self.words = words
+        self._image = None
+        self.prepared = {}  # общее для моделей этой программы, см. `FastEngine`
+
+    def __len__(self):
+        return len(self.words)
+
+    def image(self):
+        if self._image is None:
+            self._image = [decode_instruction(word) for word in self.words]
+        return self._image
+
+    def instructions(self):
+        return [instruction_from_image(*instr) for instr in self.image()]
+
+    @staticmethod
+    def is_packed(file_path):
+        with open(file_path, "rb") as file:
+            return file.read(len(packed_magic)) == packed_magic
+
+
+# Такты инструкции, включая такт выборки: (opcode, F) -> ticks (IN без данных -- 1)
+instruction_ticks = {
+    (Opcodes.NOP, None): 1,
+    (Opcodes.HALT, None): 1,
+    (Opcodes.IN, None): 2,
+    (Opcodes.OUT, None): 1,
+    (Opcodes.PUSH, None): 5,
+    (Opcodes.POP, None): 5,
+    (Opcodes.CALL, None): 5,
+    (Opcodes.RET, None): 5,
+    (Opcodes.JMP, None): 2,
+    (Opcodes.JE, None): 2,
+    (Opcodes.JNE, None): 2,
+    (Opcodes.JGE, None): 2,
+    (Opcodes.LD, 0): 2,
+    (Opcodes.LD, 1): 4,
+    (Opcodes.LD, 2): 5,
+    (Opcodes.LD, 3): 7,
+    (Opcodes.ST, 0): 3,
+    (Opcodes.ST, 1): 5,
+    (Opcodes.ST, 2): 4,
+    (Opcodes.ST, 3): 6,
+    **{(opcode, 0): 2 for opcode in alu_opcodes},
+    **{(opcode, 1): 4 for opcode in alu_opcodes},
+    **{(opcode, 3): 5 for opcode in alu_opcodes},
+}
+
+
 class ControlUnit:
     """
     Блок управления процессора. Выполняет декодирование инструкций и
@@ -319,12 +977,20 @@ class ControlUnit:
 
     data_path = None
     programm = None
+    image = None
     IP = None
     _tick = None
-
-    def __init__(self, programm, data_path):
+    stop = None
+    fault = None
+    starved = False  # IP указывает на IN, такт выборки которой уже учтён
+    trace = None
+    counters = None
+    cache = None
+
+    def __init__(self, programm, data_path, image=None):
         self.data_path = data_path
         self.programm = programm
+        self.image = image if image is not None else decode_program(programm)
         self.IP = 0
         self._tick = 0
 
@@ -334,43 +1000,47 @@ class ControlUnit:
     def current_tick(self):
         return self._tick
 
-    def execute_instruction(self, instr, data):
-        if instr == "NOP":  # NOP
+    def halt(self, reason, fault=None):
+        self.stop = reason
+        self.fault = fault
+
+    def execute_instruction(self, opcode, mode, value):
+        if opcode == Opcodes.NOP:  # NOP
             return
-        elif instr == "HALT":  # HALT
-            raise "STOP"
-        elif instr == "LD":
-            if data["F"] == 0:  # LD 5
+        elif opcode == Opcodes.HALT:  # HALT
+            self.halt(StopReasons.HALTED)
+        elif opcode == Opcodes.LD:
+            if mode == 0:  # LD 5
                 self.data_path.signal_latch_ac(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick()
-            elif data["F"] == 1:  # LD [5]
+            elif mode == 1:  # LD [5]
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(3)
                 self.data_path.signal_oe()
                 self.data_path.signal_latch_ac(magic_numbers.MUX_L_0, magic_numbers.MUX_R_DR, {"op": "ADD"})
-            elif data["F"] == 2:  # LD [SP+5]
+            elif mode == 2:  # LD [SP+5]
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(4)
                 self.data_path.signal_latch_ar(magic_numbers.MUX_L_AR, magic_numbers.MUX_R_SP, {"op": "ADD"})
                 self.data_path.signal_oe()
                 self.data_path.signal_latch_ac(magic_numbers.MUX_L_0, magic_numbers.MUX_R_DR, {"op": "ADD"})
-            elif data["F"] == 3:  # LD [[SP+5]]
+            elif mode == 3:  # LD [[SP+5]]
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(6)
                 self.data_path.signal_latch_ar(magic_numbers.MUX_L_AR, magic_numbers.MUX_R_SP, {"op": "ADD"})
@@ -379,40 +1049,40 @@ class ControlUnit:
                 self.data_path.signal_oe()
                 self.data_path.signal_latch_ac(magic_numbers.MUX_L_0, magic_numbers.MUX_R_DR, {"op": "ADD"})
             else:
-                raise "E338"
-        elif instr == "ST":
-            if data["F"] == 0:  # ST 5
+                self.halt(StopReasons.FAULT, "E338")
+        elif opcode == Opcodes.ST:
+            if mode == 0:  # ST 5
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(2)
                 self.data_path.signal_wr(magic_numbers.MUX_L_AC, magic_numbers.MUX_R_0, {"op": "ADD"})
-            elif data["F"] == 1:  # ST [5]
+            elif mode == 1:  # ST [5]
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(4)
                 self.data_path.signal_oe()
                 self.data_path.signal_latch_ar(magic_numbers.MUX_L_0, magic_numbers.MUX_R_DR, {"op": "ADD"})
                 self.data_path.signal_wr(magic_numbers.MUX_L_AC, magic_numbers.MUX_R_0, {"op": "ADD"})
-            elif data["F"] == 2:  # ST SP+5
+            elif mode == 2:  # ST SP+5
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(3)
                 self.data_path.signal_latch_ar(magic_numbers.MUX_L_AR, magic_numbers.MUX_R_SP, {"op": "ADD"})
                 self.data_path.signal_wr(magic_numbers.MUX_L_AC, magic_numbers.MUX_R_0, {"op": "ADD"})
-            elif data["F"] == 3:  # ST [SP+5]
+            elif mode == 3:  # ST [SP+5]
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(5)
                 self.data_path.signal_latch_ar(magic_numbers.MUX_L_AR, magic_numbers.MUX_R_SP, {"op": "ADD"})
@@ -420,35 +1090,37 @@ class ControlUnit:
                 self.data_path.signal_latch_ar(magic_numbers.MUX_L_0, magic_numbers.MUX_R_DR, {"op": "ADD"})
                 self.data_path.signal_wr(magic_numbers.MUX_L_AC, magic_numbers.MUX_R_0, {"op": "ADD"})
             else:
-                raise "E338"
-        elif instr in ("ADD", "SUB", "MUL", "DIV", "MOD", "CMP"):
-            if data["F"] == 0:  # ADD 5
+                self.halt(StopReasons.FAULT, "E338")
+        elif opcode in alu_opcodes:
+            if mode == 0:  # ADD 5
                 self.data_path.signal_latch_ac(
                     magic_numbers.MUX_L_AC,
                     magic_numbers.MUX_R_PR,
-                    {"op": instr, "PR": data["V"], "set_flag": True},
+                    {"op": alu_opcodes[opcode], "PR": value, "set_flag": True},
                 )
                 self.tick()
-            elif data["F"] == 1:  # LD [5]
+            elif mode == 1:  # LD [5]
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(3)
                 self.data_path.signal_oe()
                 self.data_path.signal_latch_ac(
                     magic_numbers.MUX_L_AC,
                     magic_numbers.MUX_R_DR,
-                    {"op": instr, "set_flag": True},
+                    {"op": alu_opcodes[opcode], "set_flag": True},
                 )
-            elif data["F"] == 2:  # ADD SP
-                raise "'ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'CMP' with SP not available, only [SP+V]"
-            elif data["F"] == 3:  # LD [SP+5]
+            elif mode == 2:  # ADD SP
+                self.halt(
+                    StopReasons.FAULT, "'ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'CMP' with SP not available, only [SP+V]"
+                )
+            elif mode == 3:  # LD [SP+5]
                 self.data_path.signal_latch_ar(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
                 self.tick(4)
                 self.data_path.signal_latch_ar(magic_numbers.MUX_L_AR, magic_numbers.MUX_R_SP, {"op": "ADD"})
@@ -456,42 +1128,42 @@ class ControlUnit:
                 self.data_path.signal_latch_ac(
                     magic_numbers.MUX_L_AC,
                     magic_numbers.MUX_R_DR,
-                    {"op": instr, "set_flag": True},
+                    {"op": alu_opcodes[opcode], "set_flag": True},
                 )
             else:
-                raise "E338"
-        elif instr == "JMP":
+                self.halt(StopReasons.FAULT, "E338")
+        elif opcode == Opcodes.JMP:
             self.IP = self.data_path.alu(
                 magic_numbers.MUX_L_0,
                 magic_numbers.MUX_R_PR,
-                {"op": "ADD", "PR": data["V"]},
+                {"op": "ADD", "PR": value},
             )
             self.tick()
-        elif instr == "JE":
+        elif opcode == Opcodes.JE:
             self.tick()
             if self.data_path.zero():
                 self.IP = self.data_path.alu(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
-        elif instr == "JNE":
+        elif opcode == Opcodes.JNE:
             self.tick()
             if not self.data_path.zero():
                 self.IP = self.data_path.alu(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
-        elif instr == "JGE":
+        elif opcode == Opcodes.JGE:
             self.tick()
             if not self.data_path.sign():
                 self.IP = self.data_path.alu(
                     magic_numbers.MUX_L_0,
                     magic_numbers.MUX_R_PR,
-                    {"op": "ADD", "PR": data["V"]},
+                    {"op": "ADD", "PR": value},
                 )
-        elif instr == "CALL":
+        elif opcode == Opcodes.CALL:
             self.data_path.signal_latch_sp(magic_numbers.MUX_S_DEC)
             self.tick(4)
             self.data_path.signal_latch_ar(magic_numbers.MUX_L_0, magic_numbers.MUX_R_SP, {"op": "ADD"})
@@ -503,124 +1175,1089 @@ class ControlUnit:
             self.IP = self.data_path.alu(
                 magic_numbers.MUX_L_0,
                 magic_numbers.MUX_R_PR,
-                {"op": "ADD", "PR": data["V"]},
+                {"op": "ADD", "PR": value},
             )
-        elif instr == "RET":
+        elif opcode == Opcodes.RET:
             self.data_path.signal_latch_ar(magic_numbers.MUX_L_0, magic_numbers.MUX_R_SP, {"op": "ADD"})
             self.tick(4)
             self.data_path.signal_oe()
             self.IP = self.data_path.alu(magic_numbers.MUX_L_0, magic_numbers.MUX_R_DR, {"op": "ADD"})
             self.data_path.signal_latch_sp(magic_numbers.MUX_S_INC)
-        elif instr == "PUSH":
+        elif opcode == Opcodes.PUSH:
             self.data_path.signal_latch_sp(magic_numbers.MUX_S_DEC)
             self.tick(4)
             self.data_path.signal_latch_ar(magic_numbers.MUX_L_0, magic_numbers.MUX_R_SP, {"op": "ADD"})
             self.data_path.signal_wr(magic_numbers.MUX_L_AC, magic_numbers.MUX_R_0, {"op": "ADD"})
-            # self.IP = self.data_path.alu(magic_numbers.MUX_L_0, magic_numbers.MUX_R_PR, {"op":"ADD", "PR": data["V"]})
-        elif instr == "POP":
+            # self.IP = self.data_path.alu(magic_numbers.MUX_L_0, magic_numbers.MUX_R_PR, {"op":"ADD", "PR": value})
+        elif opcode == Opcodes.POP:
             self.data_path.signal_latch_ar(magic_numbers.MUX_L_0, magic_numbers.MUX_R_SP, {"op": "ADD"})
             self.tick(4)
             self.data_path.signal_oe()
             self.data_path.signal_latch_ac(magic_numbers.MUX_L_0, magic_numbers.MUX_R_DR, {"op": "ADD"})
             self.data_path.signal_latch_sp(magic_numbers.MUX_S_INC)
-        elif instr == "IN":
-            self.data_path.signal_latch_ac(None, None, None, magic_numbers.MUX_A_INP)
+        elif opcode == Opcodes.IN:
+            try:
+                self.data_path.signal_latch_ac(None, None, None, magic_numbers.MUX_A_INP)
+            except EOFError:
+                self.IP -= 1  # IN будет выбрана повторно, когда появятся данные
+                self.starved = True
+                self.halt(StopReasons.INPUT_STARVED)
+                return
             self.tick(1)
-        elif instr == "OUT":
+        elif opcode == Opcodes.OUT:
             self.data_path.signal_out()
 
-    def decode_value(self, s):
-        import re
-
-        if re.search(r"^-?[0-9]+$", s):
-            return (0, crop_int_to_int16(int(s)))
-        if re.search(r"^\[-?[0-9]+\]$", s):
-            return (1, crop_int_to_int16(int(s[1:-1])))
-        if re.search(r"^SP[-+][0-9]+$", s):
-            return (2, crop_int_to_int16(int(s[2:])))
-        if re.search(r"^\[SP[-+][0-9]+\]$", s):
-            return (3, crop_int_to_int16(int(s[3:-1])))
-        return None
-
     def decode_and_execute_instruction(self):
-        assert 0 <= self.IP and self.IP < len(self.programm), "Unexpected end of the program"
-        instr = self.programm[self.IP].copy()
+        assert 0 <= self.IP and self.IP < len(self.image), "Unexpected end of the program"
+        opcode, mode, value = self.image[self.IP]
         self.IP += 1
-        self.tick()
-        if "operand" in instr:
-            assert self.decode_value(instr["operand"]) is not None, "Invalid operand"
-            instr["F"] = self.decode_value(instr["operand"])[0]
-            instr["V"] = self.decode_value(instr["operand"])[1]
-        self.execute_instruction(instr["instruction"], instr)
+        if self.starved:  # повторная выборка IN после нехватки ввода тактов не стоит
+            self.starved = False
+        else:
+            self.tick()
+        self.execute_instruction(opcode, mode, value)
+
+    def state(self):
+        """Регистры модели: `(IP, tick, AC, AR, SP, DR, Z, S)`."""
+        dp = self.data_path
+        return self.IP, self._tick, dp.rAC, dp.rAR, dp.rSP, dp.rDR, dp.zero(), dp.sign()
+
+    def set_state(self, state):
+        dp = self.data_path
+        self.IP, self._tick, dp.rAC, dp.rAR, dp.rSP, dp.rDR, dp.alu_flags["Z"], dp.alu_flags["S"] = state
+
+    def run(self, limit):
+        """Исполнить не более `limit` инструкций, см. `FastEngine.run`."""
+        executed = 0
+        counters = self.counters
+        cache = self.cache
+        try:
+            while executed < limit:
+                ip, tick = self.IP, self._tick
+                self.decode_and_execute_instruction()
+                if cache is not None and cache.stall:
+                    self.tick(cache.stall)
+                    cache.stall = 0
+                if self.stop is not None:
+                    break
+                executed += 1
+                if counters is not None:
+                    counters.instruction(ip, self.image[ip][0], self._tick - tick, self.IP, self.data_path.rSP)
+                logging.debug("%s", self)
+                if self.trace is not None:
+                    self.trace.append(
+                        self._tick,
+                        self.IP,
+                        self.data_path.rAC,
+                        self.data_path.rSP,
+                        self.data_path.zero(),
+                        self.data_path.sign(),
+                    )
+        except AssertionError as error:
+            self.halt(StopReasons.FAULT, str(error))
+        stop, self.stop = self.stop, None
+        return executed, stop
 
     def __repr__(self):  # TODO S Z
-        return "TICK: {:4} ACC: {:6} SP: {:6} IP: {:6} INSTR: {}".format(
-            self._tick,
-            self.data_path.rAC,
-            self.data_path.rSP,
-            self.IP,
-            self.programm[self.IP],
-        )
+        return format_state(self._tick, self.data_path.rAC, self.data_path.rSP, self.IP, self.programm[self.IP])
+
+
+class PerfCounters:
+    """
+    Счётчики производительности эталонной модели (`Machine(..., counters=...)`).
+
+    `ControlUnit` после каждой исполненной инструкции учитывает её opcode,
+    такты, адрес, исход условного перехода и глубину стека; `DataPath` --
+    чтения и записи памяти (сигналы `oe`/`wr`) и ввод-вывод. `HALT` и `IN`
+    без данных, как и в `instr_counter`, не учитываются. `to_dict` --
+    представление для JSON, `dump` -- запись в файл.
+    """
+
+    branch_opcodes = (Opcodes.JE, Opcodes.JNE, Opcodes.JGE)
+
+    def __init__(self):
+        self.instructions = Counter()  # opcode -> исполнений
+        self.ticks = Counter()  # opcode -> тактов
+        self.ip_hits = Counter()  # адрес -> исполнений
+        self.branches = {}  # адрес условного перехода -> [переход, без перехода]
+        self.memory_reads = 0
+        self.memory_writes = 0
+        self.stack_depth_max = 0
+        self.inputs = 0
+        self.outputs = 0
+
+    def instruction(self, ip, opcode, ticks, next_ip, sp):
+        self.instructions[opcode] += 1
+        self.ticks[opcode] += ticks
+        self.ip_hits[ip] += 1
+        if opcode in self.branch_opcodes:
+            outcome = self.branches.setdefault(ip, [0, 0])
+            outcome[next_ip == ip + 1] += 1
+        if -sp > self.stack_depth_max:  # стек растёт вниз от 0
+            self.stack_depth_max = -sp
+
+    def to_dict(self):
+        return {
+            "instructions": {name_by_opcode[opcode]: n for opcode, n in sorted(self.instructions.items())},
+            "ticks": {name_by_opcode[opcode]: n for opcode, n in sorted(self.ticks.items())},
+            "ip_hits": {str(ip): n for ip, n in sorted(self.ip_hits.items())},
+            "branches": {
+                str(ip): {"taken": taken, "not_taken": not_taken}
+                for ip, (taken, not_taken) in sorted(self.branches.items())
+            },
+            "memory": {"reads": self.memory_reads, "writes": self.memory_writes},
+            "stack_depth_max": self.stack_depth_max,
+            "io": {"in": self.inputs, "out": self.outputs},
+        }
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+
+def format_state(tick, ac, sp, ip, instr):
+    return "TICK: {:4} ACC: {:6} SP: {:6} IP: {:6} INSTR: {}".format(tick, ac, sp, ip, instr)
+
+
+class TraceBuffer:
+    """
+    Двоичная трасса исполнения.
+
+    После каждой инструкции (и один раз до первой) записывается запись
+    фиксированной длины `(tick, IP, AC, SP, flags)`, `flags = Z | S << 1`.
+    Записи складываются в заранее выделенный кольцевой буфер на `capacity`
+    записей: в памяти (`bytearray`) или в отображённом в память файле `path`.
+    При переполнении сохраняются последние `capacity` записей.
+
+    Текстовый журнал в прежнем формате восстанавливается `decode_trace`.
+    """
+
+    header = struct.Struct("<4sQQ")  # magic, записей всего, ёмкость
+    record = struct.Struct("<QiiqB")  # tick, IP, AC, SP, flags
+    magic = b"TRC1"
+
+    def __init__(self, capacity=1 << 20, path=None):
+        self.capacity = capacity
+        self.count = 0
+        self.file = None
+        size = self.header.size + capacity * self.record.size
+        if path is None:
+            self.data = bytearray(size)
+        else:
+            self.file = open(path, "w+b")
+            self.file.truncate(size)
+            self.data = mmap.mmap(self.file.fileno(), size)
+
+    def append(self, tick, ip, ac, sp, z, s):
+        offset = self.header.size + (self.count % self.capacity) * self.record.size
+        self.record.pack_into(self.data, offset, tick, ip, ac, sp, z | s << 1)
+        self.count += 1
+
+    def close(self):
+        self.header.pack_into(self.data, 0, self.magic, self.count, self.capacity)
+        if self.file is not None:
+            self.data.flush()
+            self.data.close()
+            self.file.close()
+            self.file = None
+
+    def records(self):
+        """Сохранённые записи `(tick, IP, AC, SP, Z, S)` по порядку."""
+        first = max(0, self.count - self.capacity)
+        for i in range(first, self.count):
+            offset = self.header.size + (i % self.capacity) * self.record.size
+            tick, ip, ac, sp, flags = self.record.unpack_from(self.data, offset)
+            yield tick, ip, ac, sp, bool(flags & 1), bool(flags & 2)
+
+    @classmethod
+    def load(cls, path):
+        """Прочитать трассу, записанную в файл."""
+        trace = cls.__new__(cls)
+        with open(path, "rb") as file:
+            trace.data = file.read()
+        magic, trace.count, trace.capacity = cls.header.unpack_from(trace.data, 0)
+        assert magic == cls.magic, "Not a trace file"
+        trace.file = None
+        return trace
+
+
+def decode_trace(trace, programm, prefix="DEBUG:root:"):
+    """Строки журнала, которые выдала бы эталонная модель с уровнем DEBUG."""
+    for tick, ip, ac, sp, _, _ in trace.records():
+        if 0 <= ip < len(programm):
+            yield prefix + format_state(tick, ac, sp, ip, programm[ip])
+
+
+def run_traced(model, trace, record, limit=10**9):
+    """Исполнить `model`, передавая каждую инструкцию в `record(ip, ticks, next_ip)`.
+
+    `trace` -- `TraceBuffer`, с которым создана модель. Записи разбираются
+    порциями по `trace.capacity - 1` инструкций, после чего буфер
+    сбрасывается, поэтому память не зависит от длины исполнения. `HALT` в
+    трассу не попадает. Возвращает `RunResult` последней порции.
+    """
+    previous = None
+    while True:
+        run = model.run(instructions=min(trace.capacity - 1, limit - model.instructions))
+        for tick, ip, _, _, _, _ in trace.records():
+            if previous is not None:
+                record(previous[1], tick - previous[0], ip)
+            previous = (tick, ip)
+        trace.count = 0
+        if run.reason != StopReasons.INSTRUCTIONS or run.instructions >= limit:
+            return run
+
+
+class FastEngine:
+    """
+    Быстрая функциональная модель процессора.
 
+    Исполняет ту же систему команд, что и `ControlUnit` + `DataPath`, но без
+    моделирования сигналов: регистры держатся в локальных переменных цикла
+    `run`, результаты АЛУ обрезаются до int32 там же, где это делает `DataPath`.
+    Выход, число инструкций и число тактов совпадают с эталонной моделью
+    (проверяется режимом `engine="lockstep"`).
+
+    Инструкции, на которых эталонная модель останавливается (`HALT`,
+    недопустимый режим адресации), заменяются на `HALT` с причиной остановки
+    в поле значения.
+
+    `prepared` -- словарь, в котором модель хранит подготовленное по образу
+    (нормализованный образ, у `BlockEngine` -- точки входа и блоки) и берёт
+    готовое: у моделей одной программы он общий (`DecodedProgram.prepared`).
+    """
+
+    def __init__(self, image, memory_manager, input_buffer, output_buffer=None, prepared=None):
+        self.memory_manager = memory_manager
+        self.input_buffer = input_buffer
+        self.output_buffer = output_buffer if output_buffer is not None else OutputPort()
+        self.prepared = prepared if prepared is not None else {}
+        if "image" not in self.prepared:
+            self.prepared["image"] = [self.normalize(opcode, mode, value) for opcode, mode, value in image]
+        self.image = self.prepared["image"]
+        self.IP = 0
+        self.AC = 0
+        self.SP = 0
+        self.Z = True
+        self.S = False
+        self._tick = 0
+        self.trace = None
+        self.fault = None
+        self.starved = False
+
+    @staticmethod
+    def normalize(opcode, mode, value):
+        if opcode == Opcodes.HALT:
+            return (Opcodes.HALT, None, StopReasons.HALTED)
+        if opcode in (Opcodes.LD, Opcodes.ST) and mode not in (0, 1, 2, 3):
+            return (Opcodes.HALT, None, StopReasons.FAULT)
+        if opcode in alu_opcodes and mode not in (0, 1, 3):
+            return (Opcodes.HALT, None, StopReasons.FAULT)
+        return (opcode, mode, value)
+
+    def current_tick(self):
+        return self._tick
+
+    def state(self):
+        """Регистры модели, как в `ControlUnit.state` (AR и DR не моделируются -- 0)."""
+        return self.IP, self._tick, self.AC, 0, self.SP, 0, self.Z, self.S
+
+    def set_state(self, state):
+        self.IP, self._tick, self.AC, _, self.SP, _, self.Z, self.S = state
+
+    def run(self, limit):  # noqa: C901 -- один цикл интерпретатора
+        """Исполнить не более `limit` инструкций.
+
+        Возвращает `(instr_counter, stop)`, где `stop` -- `None` (исчерпан
+        лимит) или причина остановки из `StopReasons`: `HALTED`, `FAULT`
+        (описание в `self.fault`) или `INPUT_STARVED` -- тогда IP указывает
+        на `IN`, и исполнение можно продолжить, когда появятся данные.
+        Такт выборки `IN` учитывается при первой попытке, поэтому `IN`,
+        дождавшаяся ввода, стоит столько же, сколько без ожидания.
+        """
+        image = self.image
+        size = self.memory_manager.size
+        mem = self.memory_manager.memory
+        inp = self.input_buffer
+        out = self.output_buffer.write
+        ip, ac, sp, z, s, tick = self.IP, self.AC, self.SP, self.Z, self.S, self._tick
+        starved = self.starved
+        n = len(image)
+        c_nop, c_halt, c_ld, c_st = Opcodes.NOP, Opcodes.HALT, Opcodes.LD, Opcodes.ST
+        c_add, c_sub, c_mul, c_div, c_cmp = Opcodes.ADD, Opcodes.SUB, Opcodes.MUL, Opcodes.DIV, Opcodes.CMP
+        c_jmp, c_je, c_jne, c_jge = Opcodes.JMP, Opcodes.JE, Opcodes.JNE, Opcodes.JGE
+        c_call, c_ret, c_push, c_pop = Opcodes.CALL, Opcodes.RET, Opcodes.PUSH, Opcodes.POP
+        c_in, c_out = Opcodes.IN, Opcodes.OUT
+        trace = self.trace.append if self.trace is not None else None
+
+        executed = 0
+        stop = None
+        try:
+            while executed < limit:
+                assert 0 <= ip < n, "Unexpected end of the program"
+                op, mode, v = image[ip]
+                ip += 1
+                if op == c_push:
+                    sp -= 1
+                    mem[(((sp + 0x80000000) & 0xFFFFFFFF) - 0x80000000) % size] = (
+                        (ac + 0x80000000) & 0xFFFFFFFF
+                    ) - 0x80000000
+                    tick += 5
+                elif op == c_pop:
+                    ac = (
+                        (mem[(((sp + 0x80000000) & 0xFFFFFFFF) - 0x80000000) % size] + 0x80000000) & 0xFFFFFFFF
+                    ) - 0x80000000
+                    sp += 1
+                    tick += 5
+                elif op == c_ld:
+                    if mode == 0:
+                        ac = v
+                        tick += 2
+                    elif mode == 1:
+                        ac = ((mem[v % size] + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                        tick += 4
+                    else:
+                        dr = mem[(((sp + v + 0x80000000) & 0xFFFFFFFF) - 0x80000000) % size]
+                        if mode == 2:
+                            tick += 5
+                        else:
+                            dr = mem[(((dr + 0x80000000) & 0xFFFFFFFF) - 0x80000000) % size]
+                            tick += 7
+                        ac = ((dr + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                elif op == c_st:
+                    if mode == 0:
+                        ar = v
+                        tick += 3
+                    elif mode == 1:
+                        ar = ((mem[v % size] + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                        tick += 5
+                    else:
+                        ar = ((sp + v + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                        if mode == 2:
+                            tick += 4
+                        else:
+                            ar = ((mem[ar % size] + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                            tick += 6
+                    mem[ar % size] = ((ac + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                elif c_add <= op <= c_cmp:
+                    if mode == 0:
+                        right = v
+                        tick += 2
+                    elif mode == 1:
+                        right = mem[v % size]
+                        tick += 4
+                    else:
+                        right = mem[(((sp + v + 0x80000000) & 0xFFFFFFFF) - 0x80000000) % size]
+                        tick += 5
+                    if op == c_cmp:
+                        res = ac - right
+                        z = res == 0
+                        s = res < 0
+                        res = ac
+                    elif op == c_add:
+                        res = ac + right
+                    elif op == c_sub:
+                        res = ac - right
+                    elif op == c_mul:
+                        res = ac * right
+                    elif op == c_div:
+                        if right == 0 and mode == 0:
+                            tick -= 1  # DataPath останавливается до последнего такта DIV n
+                        assert right != 0, "/0"
+                        res = ac // right
+                    else:
+                        if right == 0 and mode == 0:
+                            tick -= 1
+                        assert right != 0, "%0"
+                        res = ac % right
+                    if op != c_cmp:
+                        z = res == 0
+                        s = res < 0
+                    ac = ((res + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                elif op == c_je:
+                    if z:
+                        ip = v
+                    tick += 2
+                elif op == c_jne:
+                    if not z:
+                        ip = v
+                    tick += 2
+                elif op == c_jge:
+                    if not s:
+                        ip = v
+                    tick += 2
+                elif op == c_jmp:
+                    ip = v
+                    tick += 2
+                elif op == c_call:
+                    sp -= 1
+                    mem[(((sp + 0x80000000) & 0xFFFFFFFF) - 0x80000000) % size] = ip
+                    ip = v
+                    tick += 5
+                elif op == c_ret:
+                    ip = (
+                        (mem[(((sp + 0x80000000) & 0xFFFFFFFF) - 0x80000000) % size] + 0x80000000) & 0xFFFFFFFF
+                    ) - 0x80000000
+                    sp += 1
+                    tick += 5
+                elif op == c_nop:
+                    tick += 1
+                elif op == c_out:
+                    out(ac)
+                    tick += 1
+                elif op == c_in:
+                    token = inp.read()
+                    if token is None:
+                        ip -= 1
+                        tick += 0 if starved else 1
+                        starved = True
+                        stop = StopReasons.INPUT_STARVED
+                        break
+                    ac = token
+                    tick += 1 if starved else 2
+                    starved = False
+                elif op == c_halt:
+                    tick += 1
+                    stop = v
+                    break
+                executed += 1
+                if trace is not None:
+                    trace(tick, ip, ac, sp, z, s)
+        except AssertionError as error:
+            stop = StopReasons.FAULT
+            self.fault = str(error)
+
+        self.IP, self.AC, self.SP, self.Z, self.S, self._tick = ip, ac, sp, z, s, tick
+        self.starved = starved
+        return executed, stop
+
+
+def crop_expr(expr):
+    """Текст выражения, обрезающего `expr` до int32 (для генерируемого кода)."""
+    return "(((({}) + 0x80000000) & 0xFFFFFFFF) - 0x80000000)".format(expr)
+
+
+class BlockEngine(FastEngine):
+    """
+    Модель процессора с компиляцией базовых блоков.
+
+    Программа делится на базовые блоки: блок начинается с точки входа (адрес 0,
+    цель перехода или вызова, инструкция после `JMP/JE/JNE/JGE/CALL/RET`) и
+    заканчивается переходом или перед следующей точкой входа. Каждый блок при
+    первом исполнении транслируется в одну функцию Python (`compile`/`exec`),
+    которая обновляет AC/SP/флаги/память, а такты и число инструкций блока
+    прибавляются разом -- все инструкции блока имеют фиксированную стоимость.
+
+    `HALT`, `IN` (может остановить модель посреди блока) и остаток лимита,
+    в который не помещается целый блок, исполняются по одной инструкции
+    через `FastEngine.run`, поэтому счётчики совпадают с эталонной моделью.
+    `DIV`/`MOD` всегда начинают блок: деление на ноль происходит до того,
+    как блок что-либо изменил, и такая инструкция повторяется через
+    `FastEngine.run`, который останавливает модель с точными счётчиками.
+    """
+
+    ticks = instruction_ticks
+
+    terminators = (Opcodes.JMP, Opcodes.JE, Opcodes.JNE, Opcodes.JGE, Opcodes.CALL, Opcodes.RET)
+    faulting = (Opcodes.DIV, Opcodes.MOD)
+
+    def __init__(self, image, memory_manager, input_buffer, output_buffer=None, prepared=None):
+        super().__init__(image, memory_manager, input_buffer, output_buffer, prepared)
+        if "leaders" not in self.prepared:
+            self.prepared["leaders"] = self.find_leaders()
+        self.leaders = self.prepared["leaders"]
+        # текст блока зависит от размера памяти: адреса обрезаются маской или по модулю
+        key = ("blocks", self.memory_manager.size, self.memory_manager.mask)
+        if key not in self.prepared:
+            self.prepared[key] = [None] * len(self.image)
+        self.blocks = self.prepared[key]
+
+    def find_leaders(self):
+        leaders = {0}
+        for ip, (opcode, _, value) in enumerate(self.image):
+            if opcode in self.terminators:
+                leaders.add(ip + 1)
+                if opcode != Opcodes.RET:
+                    leaders.add(value)
+            elif opcode in self.faulting:
+                leaders.add(ip)
+        return leaders
+
+    def block_source(self, start):  # noqa: C901 -- по ветви на инструкцию, как в FastEngine.run
+        """Исходный текст функции блока, начинающегося с `start`, и его длина."""
+        size, mask = self.memory_manager.size, self.memory_manager.mask
+
+        def cell(address):
+            if mask is not None:  # обрезка до int32 не меняет младшие биты адреса
+                return "mem[({}) & {}]".format(address, mask)
+            return "mem[{} % {}]".format(crop_expr(address), size)
+
+        def sp_cell(value):
+            return cell("sp + {}".format(value) if value else "sp")
+
+        lines = []
+        ip = start
+        exit_expr = None
+        ac_cropped = False  # AC уже обрезан до int32 -- повторная обрезка не нужна
+        while ip < len(self.image) and exit_expr is None:
+            opcode, mode, value = self.image[ip]
+            if opcode in (Opcodes.HALT, Opcodes.IN):
+                break
+            ip += 1
+            lines.append("# {}: {} {} {}".format(ip - 1, name_by_opcode[opcode], mode, value))
+            if opcode == Opcodes.PUSH:
+                lines += ["sp -= 1", "{} = {}".format(sp_cell(0), "ac" if ac_cropped else crop_expr("ac"))]
+            elif opcode == Opcodes.POP:
+                lines += ["ac = {}".format(crop_expr(sp_cell(0))), "sp += 1"]
+            elif opcode == Opcodes.LD:
+                source = [str(value), "mem[{}]".format(value % size), sp_cell(value), cell(sp_cell(value))][mode]
+                lines.append("ac = {}".format(source if mode == 0 else crop_expr(source)))
+            elif opcode == Opcodes.ST:
+                target = [
+                    "mem[{}]".format(value % size),
+                    cell("mem[{}]".format(value % size)),
+                    sp_cell(value),
+                    cell(sp_cell(value)),
+                ][mode]
+                lines.append("{} = {}".format(target, "ac" if ac_cropped else crop_expr("ac")))
+            elif opcode in alu_opcodes:
+                lines.append(
+                    "right = {}".format({0: str(value), 1: "mem[{}]".format(value % size)}.get(mode) or sp_cell(value))
+                )
+                if opcode == Opcodes.DIV:
+                    lines.append('assert right != 0, "/0"')
+                elif opcode == Opcodes.MOD:
+                    lines.append('assert right != 0, "%0"')
+                sign = {Opcodes.ADD: "+", Opcodes.SUB: "-", Opcodes.MUL: "*", Opcodes.DIV: "//", Opcodes.MOD: "%"}
+                lines.append("res = ac {} right".format(sign.get(opcode, "-")))
+                lines += ["z = res == 0", "s = res < 0"]
+                if opcode != Opcodes.CMP:
+                    lines.append("ac = {}".format(crop_expr("res")))
+                elif not ac_cropped:
+                    lines.append("ac = {}".format(crop_expr("ac")))
+            elif opcode == Opcodes.OUT:
+                lines.append("out(ac)")
+            elif opcode == Opcodes.JMP:
+                exit_expr = str(value)
+            elif opcode == Opcodes.JE:
+                exit_expr = "{} if z else {}".format(value, ip)
+            elif opcode == Opcodes.JNE:
+                exit_expr = "{} if not z else {}".format(value, ip)
+            elif opcode == Opcodes.JGE:
+                exit_expr = "{} if not s else {}".format(value, ip)
+            elif opcode == Opcodes.CALL:
+                lines += ["sp -= 1", "{} = {}".format(sp_cell(0), ip)]
+                exit_expr = str(value)
+            elif opcode == Opcodes.RET:
+                lines += ["ip = {}".format(crop_expr(sp_cell(0))), "sp += 1"]
+                exit_expr = "ip"
+            ac_cropped = ac_cropped or opcode in (Opcodes.POP, Opcodes.LD) or opcode in alu_opcodes
+            if ip in self.leaders:
+                break
+        if exit_expr is None:
+            exit_expr = str(ip)
+        body = "".join("    {}\n".format(line) for line in lines)
+        source = "def block(ac, sp, z, s, mem, out):\n{}    return {}, ac, sp, z, s\n".format(body, exit_expr)
+        return source, ip - start
+
+    def compile_block(self, start):
+        source, length = self.block_source(start)
+        ticks = sum(self.ticks[self.image[ip][0], self.image[ip][1]] for ip in range(start, start + length))
+        namespace = {}  # память и порт вывода -- аргументы: блоки общие для моделей одной программы
+        exec(compile(source, "<block {}>".format(start), "exec"), namespace)
+        return namespace["block"], length, ticks
+
+    def run_blocks(self, limit):
+        """Исполнять целые блоки, пока они помещаются в `limit`.
+
+        Возвращает `(instr_counter, fits)`; `fits` ложно, если следующий блок
+        не помещается в остаток лимита. Блок, который нельзя исполнить целиком
+        (IP вне программы, деление на ноль в его первой инструкции), не
+        исполняется: его первую инструкцию выполнит `FastEngine.run`.
+        """
+        blocks = self.blocks
+        n = len(blocks)
+        mem, out = self.memory_manager.memory, self.output_buffer.write
+        ip, ac, sp, z, s, tick = self.IP, self.AC, self.SP, self.Z, self.S, self._tick
+        executed = 0
+        fits = True
+        while True:
+            if not 0 <= ip < n:
+                break
+            block = blocks[ip]
+            if block is None:
+                block = blocks[ip] = self.compile_block(ip)
+            function, length, ticks = block
+            if length == 0:
+                break
+            if executed + length > limit:
+                fits = False
+                break
+            try:
+                ip, ac, sp, z, s = function(ac, sp, z, s, mem, out)
+            except AssertionError:  # сбой в первой инструкции блока, состояние не изменилось
+                break
+            executed += length
+            tick += ticks
+        self.IP, self.AC, self.SP, self.Z, self.S, self._tick = ip, ac, sp, z, s, tick
+        return executed, fits
+
+    def run(self, limit):
+        if self.trace is not None:  # трасса нужна после каждой инструкции
+            return FastEngine.run(self, limit)
+        executed = 0
+        stop = None
+        while executed < limit and stop is None:
+            done, fits = self.run_blocks(limit - executed)
+            executed += done
+            step = 1 if fits else limit - executed
+            done, stop = FastEngine.run(self, min(step, limit - executed))
+            executed += done
+        return executed, stop
+
+
+RunResult = namedtuple("RunResult", ["reason", "instructions", "ticks"])
+
+
+class QueuePipe:
+    """
+    Канал внутри процесса на `asyncio.Queue` -- замена потоку или сокету.
 
-def simulation(code, input_tokens, data_memory_size, limit):
-    mm = MemoryManager(data_memory_size)
+    С одной стороны `write(bytes)`/`drain()`/`close()` (как у
+    `asyncio.StreamWriter`), с другой -- `read(n)` (как у
+    `asyncio.StreamReader`): ждёт данных, после `close` возвращает `b""`.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.pending = b""
+        self.eof = False
+
+    def write(self, data):
+        if data:
+            self.queue.put_nowait(bytes(data))
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.queue.put_nowait(b"")
+
+    async def read(self, n=-1):
+        if self.eof:
+            return b""
+        chunk = self.pending or await self.queue.get()
+        self.eof = not chunk
+        if 0 <= n < len(chunk):
+            self.pending = chunk[n:]
+            return chunk[:n]
+        self.pending = b""
+        return chunk
+
+
+def split_data_segment(code):
+    """Разделить программу на сегмент данных и инструкции (код не изменяется)."""
     if len(code) > 0 and isinstance(code[0], list):
-        for i in range(len(code[0])):
-            mm.setmem(i, code[0][i])
-        code.pop(0)
-    data_path = DataPath(mm, input_tokens)
-    control_unit = ControlUnit(code, data_path)
+        return code[0], code[1:]
+    return [], list(code)
+
+
+class Machine:
+    """
+    Модель процессора, исполняемая порциями.
+
+    `run` исполняет программу, пока не исчерпан один из бюджетов порции
+    (инструкции, такты, секунды) или модель не остановилась, и возвращает
+    `RunResult(reason, instructions, ticks)` с причиной из `StopReasons` и
+    счётчиками с начала работы. Повторный `run` продолжает с того же места:
+    так можно по очереди исполнять много программ. После `HALTED` и `FAULT`
+    модель не продолжается; после `INPUT_STARVED` IP указывает на `IN`, и
+    исполнение возобновляется, когда во входном порту появятся данные.
+    Бюджет тактов не превышается: порция останавливается (`TICKS`) перед
+    инструкцией, такты которой в остаток бюджета не помещаются.
+    """
+
+    max_instruction_ticks = 7  # LD [[SP+n]]
+    max_stall_ticks = 0  # задержка кэша на инструкцию
+    time_slice = 1 << 14  # инструкций между проверками часов
+
+    def __init__(
+        self,
+        code,
+        input_port=None,
+        output_port=None,
+        data_memory_size=1000,
+        engine="fast",
+        trace=None,
+        counters=None,
+        cache=None,
+        memory=None,
+    ):
+        assert engine in ("signal", "fast", "block"), "Unknown engine: " + str(engine)
+        assert counters is None or engine == "signal", "Performance counters need the signal engine"
+        # fast/block не моделируют отдельные обращения к памяти -- задержки кэша им некуда прибавить
+        assert cache is None or engine == "signal", "Data cache model needs the signal engine, not " + engine
+        if isinstance(code, (PackedProgram, DecodedProgram)):
+            data, image = code.data, code.image()
+            programm = code.instructions() if engine == "signal" else None
+        else:
+            data, programm = split_data_segment(code)
+            image = decode_program(programm)
+        self.image = image
+        self._digest = None
+        # `memory` -- готовая память данных (например, `PagedMemory`) вместо `MemoryManager(data_memory_size)`
+        self.memory_manager = memory if memory is not None else MemoryManager(data_memory_size)
+        self.memory_manager.load(0, data)
+        self.input_port = input_port if input_port is not None else InputPort()
+        self.output_port = output_port if output_port is not None else OutputPort()
+        self.cache = cache
+        if engine == "signal":
+            memory = cache.attach(self.memory_manager) if cache is not None else self.memory_manager
+            data_path = DataPath(memory, self.input_port, self.output_port)
+            self.engine = ControlUnit(programm, data_path, image)
+            self.engine.counters = data_path.counters = counters
+            self.engine.cache = cache
+            if cache is not None:  # LD [[SP+n]] читает память дважды
+                self.max_stall_ticks = 2 * cache.max_access_ticks()
+                self.max_instruction_ticks = Machine.max_instruction_ticks + self.max_stall_ticks
+            logging.debug("%s", self.engine)
+        else:
+            engine_class = FastEngine if engine == "fast" else BlockEngine
+            prepared = code.prepared if isinstance(code, (PackedProgram, DecodedProgram)) else None
+            self.engine = engine_class(image, self.memory_manager, self.input_port, self.output_port, prepared)
+        if trace is not None:
+            trace.append(0, 0, 0, 0, True, False)
+            self.engine.trace = trace
+        self.instructions = 0
+        self.stopped = None
+        self.fault = None
+
+    def ticks(self):
+        return self.engine.current_tick()
+
+    @property
+    def digest(self):
+        """sha256 предекодированной программы: снимок восстанавливается только в той же программе."""
+        if self._digest is None:
+            self._digest = hashlib.sha256(repr(self.image).encode()).digest()
+        return self._digest
+
+    # Заголовок снимка: сигнатура, sha256 программы, регистры IP, tick, AC, AR, SP, DR и флаги, число
+    # инструкций, причина остановки (или ожидание ввода), прочитано из порта ввода, выведено, размер
+    # памяти и формат её снимка (`snapshot_kind`). Далее -- память, сжатая zlib.
+    checkpoint_header = struct.Struct("<4s32sqQqqqqBQBQQQB")
+    checkpoint_magic = b"CHK2"
+    checkpoint_stops = (None, StopReasons.HALTED, StopReasons.FAULT, StopReasons.INPUT_STARVED)
+
+    def checkpoint(self):
+        """Снимок состояния модели в компактном двоичном виде.
+
+        Память сжимается zlib (нетронутые нули почти ничего не занимают).
+        Снимок не зависит от модели исполнения: его можно восстановить в
+        `Machine` с другим `engine`, но той же программой.
+        """
+        ip, tick, ac, ar, sp, dr, z, s = self.engine.state()
+        header = self.checkpoint_header.pack(
+            self.checkpoint_magic,
+            self.digest,
+            ip,
+            tick,
+            ac,
+            ar,
+            sp,
+            dr,
+            z | s << 1,
+            self.instructions,
+            self.checkpoint_stops.index(StopReasons.INPUT_STARVED if self.engine.starved else self.stopped),
+            self.input_port.consumed,
+            self.output_port.count(),
+            self.memory_manager.size,
+            self.memory_manager.snapshot_kind,
+        )
+        return header + self.memory_manager.snapshot()
+
+    def restore(self, data, skip_input=True):
+        """Восстановить состояние из `checkpoint()`.
+
+        Если `skip_input`, из порта ввода пропускаются токены, прочитанные до
+        снимка (порт должен быть открыт на том же вводе с начала).
+        """
+        fields = self.checkpoint_header.unpack_from(data, 0)
+        magic, digest, ip, tick, ac, ar, sp, dr, flags, instructions, stopped, consumed, written, size, kind = fields
+        assert magic == self.checkpoint_magic, "Not a checkpoint"
+        assert digest == self.digest, "Checkpoint belongs to another program"
+        assert size == self.memory_manager.size, "Data memory size mismatch"
+        assert kind == self.memory_manager.snapshot_kind, "Data memory kind mismatch"
+        self.memory_manager.restore_snapshot(data[self.checkpoint_header.size :])
+        self.engine.set_state((ip, tick, ac, ar, sp, dr, bool(flags & 1), bool(flags & 2)))
+        self.instructions = instructions
+        self.stopped = self.checkpoint_stops[stopped]
+        self.engine.starved = self.stopped == StopReasons.INPUT_STARVED
+        if self.engine.starved:  # модель не остановлена, IN ждёт ввода
+            self.stopped = None
+        if skip_input:
+            self.input_port.skip(consumed - self.input_port.consumed)
+        self.output_port.flushed = written - len(self.output_port.buffer)
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.checkpoint())
+
+    def load(self, path, skip_input=True):
+        with open(path, "rb") as file:
+            self.restore(file.read(), skip_input)
+
+    async def run_async(self, reader, writer=None, instructions=None, chunk_size=1 << 16):
+        """Исполнять программу, подкачивая ввод из `reader` по мере надобности.
+
+        `reader` -- `asyncio.StreamReader` или объект с `async read(n)` (`b""`
+        -- конец ввода). Когда `IN` нечего читать, модель ждёт данных, уступая
+        цикл событий; между порциями по `time_slice` инструкций -- тоже, так
+        что в одном процессе могут работать многие модели. Вывод после каждой
+        порции передаётся в `writer` (`write(bytes)`, `async drain()`), если
+        он задан. Ожидание ввода тактов не тратит: результат совпадает с
+        обычным запуском на том же вводе. `instructions` -- лимит, как у `run`.
+        """
+        start = self.instructions
+        while True:
+            step = self.time_slice
+            if instructions is not None:
+                step = min(step, instructions - (self.instructions - start))
+            result = self.run(instructions=step)
+            if writer is not None and self.output_port.buffer:
+                value = self.output_port.take()
+                writer.write(value if isinstance(value, bytes) else value.encode("utf-8"))
+                await writer.drain()
+            if result.reason == StopReasons.INPUT_STARVED and not self.input_port.closed:
+                self.input_port.feed(await reader.read(chunk_size))
+            elif result.reason != StopReasons.INSTRUCTIONS or step <= 0:
+                return result
+            else:
+                await asyncio.sleep(0)
+
+    def next_instruction_ticks(self):
+        """Наибольшее число тактов следующей инструкции (с задержками кэша)."""
+        ip = self.engine.state()[0]
+        if not 0 <= ip < len(self.image):
+            return 0  # сбой тактов не тратит
+        opcode, mode, _ = FastEngine.normalize(*self.image[ip])
+        if opcode == Opcodes.IN and self.engine.starved:
+            return 1
+        return instruction_ticks.get((opcode, mode), 1) + self.max_stall_ticks  # HALT -- один такт
+
+    def ticks_fit(self, left):
+        """Сколько инструкций заведомо укладывается в `left` тактов (0 -- ни одной)."""
+        # ни одна инструкция не дороже max_instruction_ticks, а у конца бюджета следующая
+        # исполняется, только если её такты в него помещаются -- порция не выйдет за бюджет
+        if left >= self.max_instruction_ticks:
+            return left // self.max_instruction_ticks
+        return 1 if 0 < left and self.next_instruction_ticks() <= left else 0
+
+    def run(self, instructions=None, ticks=None, seconds=None):
+        if self.stopped is not None:
+            return RunResult(self.stopped, self.instructions, self.ticks())
+        start_tick = self.ticks()
+        deadline = time.perf_counter() + seconds if seconds is not None else None
+        done = 0
+        reason = None
+        while reason is None:
+            step = instructions - done if instructions is not None else self.time_slice
+            if ticks is not None:
+                fits = self.ticks_fit(ticks - (self.ticks() - start_tick))
+                if fits == 0:
+                    reason = StopReasons.TICKS
+                    break
+                step = min(step, fits)
+            if deadline is not None:
+                step = min(step, self.time_slice)
+            if step <= 0:
+                reason = StopReasons.INSTRUCTIONS
+                break
+            executed, reason = self.engine.run(step)
+            done += executed
+            self.instructions += executed
+            if reason is None and deadline is not None and time.perf_counter() >= deadline:
+                reason = StopReasons.TIME
+        if reason in (StopReasons.HALTED, StopReasons.FAULT):
+            self.stopped = reason
+            self.fault = self.engine.fault
+        return RunResult(reason, self.instructions, self.ticks())
+
+
+def lockstep_simulation(code, input_tokens, data_memory_size, limit, trace=None):
+    """Пошаговая сверка `FastEngine` с эталонной моделью `ControlUnit`.
+
+    Обе модели получают собственные копии памяти и входа. После каждой
+    инструкции сравниваются IP, AC, SP, флаги, такты, вывод и причина
+    остановки, в конце -- вся память. Расхождение приводит к `AssertionError`.
+    """
+    input_tokens = list(input_tokens)
+    reference = Machine(code, InputPort(input_tokens), data_memory_size=data_memory_size, engine="signal")
+    fast = Machine(code, InputPort(input_tokens), data_memory_size=data_memory_size, engine="fast", trace=trace)
+    control_unit, data_path, engine = reference.engine, reference.engine.data_path, fast.engine
     instr_counter = 0
 
-    logging.debug("%s", control_unit)
-    try:
-        while instr_counter < limit:
-            control_unit.decode_and_execute_instruction()
-            instr_counter += 1
-            logging.debug("%s", control_unit)
-    except EOFError:
-        logging.warning("Input buffer is empty!")
-    except TypeError:
-        pass
+    while instr_counter < limit:
+        _, ref_stop = control_unit.run(1)
+        _, stop = engine.run(1)
+        ref_state = (
+            control_unit.IP,
+            data_path.rAC,
+            data_path.rSP,
+            data_path.zero(),
+            data_path.sign(),
+            control_unit.current_tick(),
+            data_path.output_buffer.count(),
+            ref_stop,
+        )
+        fast_state = (
+            engine.IP,
+            engine.AC,
+            engine.SP,
+            engine.Z,
+            engine.S,
+            engine.current_tick(),
+            engine.output_buffer.count(),
+            stop,
+        )
+        assert ref_state == fast_state, "Engines diverged after {} instructions: {} != {}".format(
+            instr_counter, ref_state, fast_state
+        )
+        if stop is not None:
+            break
+        instr_counter += 1
+
+    assert reference.memory_manager.memory == fast.memory_manager.memory, "Engines diverged: data memory differs"
+    assert data_path.output_buffer.getvalue() == engine.output_buffer.getvalue(), "Engines diverged: output differs"
+    return engine.output_buffer.getvalue(), instr_counter, engine.current_tick(), stop
+
+
+def log_reports(counters, cache, memory):
+    """Итоги счётчиков, модели кэша и страничной памяти (если они заданы) -- в журнал."""
+    if counters is not None:
+        logging.info("counters: %s", json.dumps(counters.to_dict()))
+    if cache is not None:
+        logging.info("cache: %s", json.dumps(cache.to_dict()))
+    if isinstance(memory, PagedMemory):
+        logging.info("resident pages: %d of %d words", memory.resident_pages(), memory.page_size)
+
+
+def simulation(
+    code,
+    input_tokens,
+    data_memory_size,
+    limit,
+    engine="signal",
+    output_port=None,
+    trace=None,
+    counters=None,
+    cache=None,
+    memory=None,
+):
+    """Запуск модели процессора до остановки или до `limit` инструкций.
+
+    `engine` выбирает модель: `"signal"` -- эталонная потактовая модель
+    (`ControlUnit` + `DataPath`, журнал каждой инструкции в DEBUG), `"fast"` --
+    `FastEngine`, `"block"` -- `BlockEngine` (компиляция базовых блоков),
+    `"lockstep"` -- эталонная и быстрая модели с пошаговой сверкой.
+
+    Вывод по умолчанию накапливается и возвращается первым элементом; если
+    передан `output_port` с `sink`, вывод уходит в него по ходу работы, а
+    возвращается невыведенный остаток (после `flush` -- пустой).
+
+    `trace` -- `TraceBuffer` для двоичной трассы (закрывается по окончании).
+    `counters` -- `PerfCounters`, `cache` -- `DataCache` (только для `"signal"`),
+    их итоги пишутся в журнал. `memory` -- память данных вместо
+    `MemoryManager(data_memory_size)`, например `PagedMemory`.
+    """
+    assert engine in ("signal", "fast", "block", "lockstep"), "Unknown engine: " + str(engine)
+    output_port = output_port if output_port is not None else OutputPort()
+    if engine == "lockstep":
+        assert counters is None, "Performance counters need the signal engine"
+        assert cache is None, "Data cache model needs the signal engine"
+        assert memory is None, "Lockstep engines need separate memories"
+        output, instr_counter, ticks, reason = lockstep_simulation(code, input_tokens, data_memory_size, limit, trace)
+        for symbol in output:  # сверка идёт на накопленном выводе, в порт он передаётся в конце
+            output_port.write(ord(symbol))
+        fault = None
+    else:
+        input_port = input_tokens if isinstance(input_tokens, InputPort) else InputPort(input_tokens)
+        model = Machine(code, input_port, output_port, data_memory_size, engine, trace, counters, cache, memory)
+        reason, instr_counter, ticks = model.run(instructions=limit)
+        fault = model.fault
 
+    if reason == StopReasons.INPUT_STARVED:
+        logging.warning("Input buffer is empty!")
+    elif reason == StopReasons.FAULT:
+        logging.warning("Fault: %s", fault)
     if instr_counter >= limit:
         logging.warning("Limit exceeded!")
-    logging.info("output_buffer: %s", repr("".join(data_path.output_buffer)))
-    return "".join(data_path.output_buffer), instr_counter, control_unit.current_tick()
-
-
-def machine(code_file, input_file, debug_file=None):
-    def read_code(file_name):
-        try:
-            import json
+    if trace is not None:
+        trace.close()
+    log_reports(counters, cache, memory)
+    output_port.flush()
+    if output_port.sink is None:
+        logging.info("output_buffer: %s", repr(output_port.getvalue()))
+    else:
+        logging.info("output written: %d", output_port.count())
+    return output_port.getvalue(), instr_counter, ticks
 
-            programm = []
-            with open(file_name) as f:
-                programm = json.load(f)
-            return programm
-        except:
-            print("Reading code error")
-            exit(1)
 
+def read_code(file_name):
+    """Прочитать программу: JSON транслятора или упакованный двоичный формат."""
+    try:
+        if PackedProgram.is_packed(file_name):
+            return PackedProgram(file_name)
+        programm = []
+        with open(file_name) as f:
+            programm = json.load(f)
+        return programm
+    except:
+        print("Reading code error")
+        exit(1)
+
+
+def machine(
+    code_file,
+    input_file,
+    debug_file=None,
+    engine="signal",
+    trace_file=None,
+    limit=1500,
+    data_memory_size=1000,
+    counters_file=None,
+    cache=None,
+):
     if debug_file is not None:
         logging.basicConfig(filename=debug_file, filemode="w", level=logging.DEBUG, force=True)
     code = read_code(code_file)
-    input_token = []
-    with open(input_file, encoding="utf-8") as file:
-        input_text = file.read()
-        for char in input_text:
-            input_token.append(ord(char))
-        input_token.append(0)
-
-    output, instr_counter, ticks = simulation(code, input_tokens=input_token, data_memory_size=1000, limit=1500)
+    # Без журнала вывод идёт в stdout по ходу работы; журнал отладки содержит
+    # весь вывод целиком, поэтому в этом режиме он накапливается.
+    output_port = OutputPort() if debug_file is not None else OutputPort(sink=sys.stdout.write)
+    counters = PerfCounters() if counters_file is not None else None
+    with open(input_file, "rb") if input_file != "-" else open(sys.stdin.fileno(), "rb", closefd=False) as file:
+        output, instr_counter, ticks = simulation(
+            code,
+            input_tokens=InputPort(fd=file.fileno()),
+            data_memory_size=data_memory_size,
+            limit=limit,
+            engine=engine,
+            output_port=output_port,
+            trace=TraceBuffer(path=trace_file) if trace_file is not None else None,
+            counters=counters,
+            cache=cache,
+        )
+    if counters is not None:
+        counters.dump(counters_file)
 
-    print("".join(output))
+    print(output)
     print("instr_counter: ", instr_counter, "ticks:", ticks)
+    if cache is not None:
+        print("cache hit rate: {:.3f}".format(cache.hit_rate()), json.dumps(cache.to_dict()))
 
 
 if __name__ == "__main__":
     logging.getLogger().setLevel(logging.DEBUG)
-    assert len(sys.argv) == 3, "Wrong arguments: machine.py <code_file> <input_file>"
-    _, code_file, input_file = sys.argv
-    machine(code_file, input_file)
+    assert len(sys.argv) in (3, 4), "Wrong arguments: machine.py <code_file> <input_file> [signal|fast|block|lockstep]"
+    _, code_file, input_file, *engine = sys.argv
+    machine(code_file, input_file, engine=engine[0] if engine else "signal")
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+"""Конвейерная модель времени исполнения.
+
+Модель не меняет исполнение: она получает поток исполненных инструкций
+(`machine.run_traced`) и считает, сколько тактов заняла бы та же программа на
+четырёхстадийном конвейере fetch/decode/execute/memory с одной инструкцией на
+стадии:
+
+- execute -- АЛУ, вычисление адреса, изменение SP, проверка условия перехода;
+- memory -- обращения к памяти, по такту на каждое (`LD [[SP+n]]` -- два),
+  пока стадия занята, следующая инструкция ждёт (структурный конфликт);
+- AC и флаги, прочитанные из памяти, готовы после memory, вычисленные в
+  execute -- после execute; с `forwarding` значения передаются в execute
+  (данные для записи в память -- в memory) следующей инструкции, без него
+  читаются на decode после завершения memory производителя;
+- `JMP`/`CALL` и предсказанный переход выбираются после decode (такт
+  простоя), неверно предсказанный условный переход -- после execute
+  (два такта), `RET` -- после чтения адреса возврата в memory.
+
+Результат -- разбивка CPI: базовый такт на инструкцию, заполнение конвейера,
+простои по данным (по регистрам), структурные и на переходах, и точность
+предсказателя. Предсказатели -- `predictors`, можно передать свой объект с
+методами `predict(ip, target)` и `update(ip, taken)`.
+"""
+
+import json
+import sys
+from collections import Counter
+
+import machine
+
+Opcodes = machine.Opcodes
+execute, memory = 2, 3  # номера стадий fetch, decode, execute, memory
+
+
+class StaticPredictor:
+    """Статическое предсказание: переход назад (цикл) выполняется, вперёд -- нет."""
+
+    def predict(self, ip, target):
+        return target <= ip
+
+    def update(self, ip, taken):
+        pass
+
+
+class OneBitPredictor:
+    """Таблица из `entries` битов по младшим битам адреса: повторяется последний исход."""
+
+    def __init__(self, entries=64):
+        self.mask = entries - 1
+        self.table = [False] * entries
+
+    def predict(self, ip, target):
+        return self.table[ip & self.mask]
+
+    def update(self, ip, taken):
+        self.table[ip & self.mask] = taken
+
+
+class TwoBitPredictor:
+    """Таблица двухбитовых насыщающихся счётчиков (0..3, переход при 2 и 3)."""
+
+    def __init__(self, entries=64):
+        self.mask = entries - 1
+        self.table = [1] * entries
+
+    def predict(self, ip, target):
+        return self.table[ip & self.mask] >= 2
+
+    def update(self, ip, taken):
+        counter = self.table[ip & self.mask]
+        self.table[ip & self.mask] = min(counter + 1, 3) if taken else max(counter - 1, 0)
+
+
+predictors = {"static": StaticPredictor, "1bit": OneBitPredictor, "2bit": TwoBitPredictor}
+
+
+def instruction_info(opcode, mode):
+    """`(обращений к памяти, читаемые регистры, записываемые регистры)` инструкции.
+
+    Читаемые -- пары `(регистр, стадия, на которой нужно значение)`.
+    """
+    reads = {
+        Opcodes.LD: (0, 1, 1, 2),
+        Opcodes.ST: (0, 1, 0, 1),
+        Opcodes.CALL: (0,),
+        Opcodes.RET: (1,),
+        Opcodes.PUSH: (0,),
+        Opcodes.POP: (1,),
+    }
+    writes = {Opcodes.ST: (1, 1, 1, 1), Opcodes.CALL: (1,), Opcodes.PUSH: (1,)}
+    if opcode in machine.alu_opcodes:
+        loads, stores = (0, 1, 0, 1)[mode], 0
+    else:
+        loads = reads.get(opcode, (0, 0, 0, 0))[mode or 0]
+        stores = writes.get(opcode, (0, 0, 0, 0))[mode or 0]
+    accesses = loads + stores
+    needs, produces = [], []
+    ready = memory if loads else execute
+    if opcode in machine.alu_opcodes:
+        needs.append(("AC", execute))
+        produces.extend([("AC", ready), ("flags", ready)] if opcode != Opcodes.CMP else [("flags", ready)])
+    elif opcode in (Opcodes.LD, Opcodes.POP, Opcodes.IN):
+        produces.append(("AC", ready))
+    elif opcode in (Opcodes.ST, Opcodes.PUSH):
+        needs.append(("AC", memory))
+    elif opcode == Opcodes.OUT:
+        needs.append(("AC", execute))
+    elif opcode in (Opcodes.JE, Opcodes.JNE, Opcodes.JGE):
+        needs.append(("flags", execute))
+    if mode in (2, 3) or opcode in (Opcodes.CALL, Opcodes.RET, Opcodes.PUSH, Opcodes.POP):
+        needs.append(("SP", execute))
+    if opcode in (Opcodes.CALL, Opcodes.RET, Opcodes.PUSH, Opcodes.POP):
+        produces.append(("SP", execute))
+    return accesses, tuple(needs), tuple(produces)
+
+
+class Pipeline:
+    """Накопитель модели: `record` получает исполненные инструкции по порядку."""
+
+    stages = ("fetch", "decode", "execute", "memory")
+    branch_opcodes = (Opcodes.JE, Opcodes.JNE, Opcodes.JGE)
+
+    def __init__(self, image, predictor="2bit", forwarding=True):
+        self.image = image
+        self.predictor = predictors[predictor]() if isinstance(predictor, str) else predictor
+        self.forwarding = forwarding
+        self.info = {}  # (opcode, mode) -> instruction_info
+        self.instructions = 0
+        self.execute_at = execute - 1  # такт, в который предыдущая инструкция была на execute
+        self.memory_cycles = 1
+        self.penalty = 0  # простой после предыдущей инструкции (переход)
+        self.ready = {}  # регистр -> такт, с которого значение доступно
+        self.stalls = Counter()  # причина -> такты простоя
+        self.branches = Counter()  # "predicted", "mispredicted"
+
+    def record(self, ip, ticks, next_ip):
+        opcode, mode, value = self.image[ip]
+        info = self.info.get((opcode, mode))
+        if info is None:
+            info = self.info[(opcode, mode)] = instruction_info(opcode, mode)
+        accesses, needs, produces = info
+        cycle = self.execute_at + 1 + self.penalty
+        self.stalls["control"] += self.penalty
+        # memory предыдущей инструкции должна освободиться
+        start = max(cycle, self.execute_at + self.memory_cycles)
+        self.stalls["structural"] += start - cycle
+        cycle = start
+        for register, stage in needs:
+            available = self.ready.get(register, 0)
+            start = available - (stage - execute) if self.forwarding else available + 1
+            if start > cycle:
+                self.stalls[register] += start - cycle
+                cycle = start
+        self.execute_at = cycle
+        self.memory_cycles = max(1, accesses)
+        for register, stage in produces:
+            if self.forwarding:
+                self.ready[register] = cycle + 1 if stage == execute else cycle + self.memory_cycles + 1
+            else:
+                self.ready[register] = cycle + self.memory_cycles + 1
+        self.penalty = self.branch_penalty(ip, opcode, value, next_ip)
+        self.instructions += 1
+
+    def branch_penalty(self, ip, opcode, target, next_ip):
+        # простой -- число тактов между стадией, на которой известен адрес, и fetch следующей инструкции
+        if opcode in (Opcodes.JMP, Opcodes.CALL):
+            return 1
+        if opcode == Opcodes.RET:
+            return self.memory_cycles + 2
+        if opcode not in self.branch_opcodes:
+            return 0
+        taken = next_ip != ip + 1
+        predicted = self.predictor.predict(ip, target)
+        self.predictor.update(ip, taken)
+        self.branches["predicted" if predicted == taken else "mispredicted"] += 1
+        if predicted != taken:
+            return 2
+        return 1 if taken else 0
+
+    def cycles(self):
+        """Такт завершения последней инструкции (с заполнением конвейера)."""
+        return self.execute_at + self.memory_cycles + 1 if self.instructions else 0
+
+    def to_dict(self):
+        n = self.instructions or 1
+        cycles = self.cycles()
+        stalls = sum(self.stalls.values())
+        branches = sum(self.branches.values())
+        return {
+            "instructions": self.instructions,
+            "cycles": cycles,
+            "cpi": cycles / n,
+            "breakdown": {
+                "base": self.instructions / n,
+                "fill": (cycles - self.instructions - stalls) / n,
+                "data": {register: self.stalls[register] / n for register in ("AC", "SP", "flags")},
+                "structural": self.stalls["structural"] / n,
+                "control": self.stalls["control"] / n,
+            },
+            "branches": {
+                "conditional": branches,
+                "mispredicted": self.branches["mispredicted"],
+                "accuracy": self.branches["predicted"] / branches if branches else 1.0,
+            },
+        }
+
+
+def simulate(code, input_port, predictor="2bit", forwarding=True, engine="fast", limit=10**9, chunk=1 << 16):
+    """Исполнить программу и вернуть `(Pipeline, RunResult)`."""
+    trace = machine.TraceBuffer(capacity=chunk + 1)
+    model = machine.Machine(code, input_port, engine=engine, trace=trace)
+    result = Pipeline(model.image, predictor, forwarding)
+    return result, machine.run_traced(model, trace, result.record, limit)
+
+
+def pipeline(code_file, input_file, predictor="2bit", forwarding=True, limit=10**9):
+    code = machine.read_code(code_file)
+    with open(input_file, "rb") as file:
+        result, run = simulate(code, machine.InputPort(fd=file.fileno()), predictor, forwarding, limit=limit)
+    print("reason:", run.reason, "instr_counter:", run.instructions, "ticks:", run.ticks)
+    print(json.dumps(result.to_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    assert len(sys.argv) in (3, 4, 5), (
+        "Wrong arguments: pipeline.py <code_file> <input_file> [static|1bit|2bit] [forwarding|no-forwarding]"
+    )
+    _, code_file, input_file, *rest = sys.argv
+    pipeline(code_file, input_file, rest[0] if rest else "2bit", rest[1:] != ["no-forwarding"])
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+"""Профилировщик программ на уровне исходного кода Lisp.
+
+Программа исполняется моделью процессора с двоичной трассой
+(`machine.TraceBuffer`), такты каждой инструкции относятся к исходному коду
+по карте, которую пишет транслятор (`translator.py ... --map=<file>`).
+Стек вызовов восстанавливается по `CALL`/`RET` (и `JMP` на вход функции --
+хвостовой вызов, режим `tco`); верхний уровень программы -- `main`.
+
+Результат: такты по функциям (включительно и исключительно, число вызовов),
+по строкам и по циклам `while` (инструкции самого цикла, без вложенных циклов
+и вызовов) и стеки в свёрнутом формате (`main;f;g 123`) для flame graph.
+"""
+
+import json
+import sys
+from collections import Counter
+
+import machine
+
+
+class Profile:
+    """Накопитель профиля: `record` получает соседние записи трассы."""
+
+    root = "main"
+
+    def __init__(self, image, source_map):
+        self.image = image
+        self.source_map = source_map
+        self.entries = {function["entry"]: function["name"] for function in source_map["functions"]}
+        self.stack = (self.root,)
+        self.ip_ticks = Counter()  # адрес -> такты
+        self.stacks = Counter()  # стек вызовов -> такты исключительно в его вершине
+        self.calls = Counter()
+
+    def record(self, ip, ticks, next_ip):
+        """Инструкция по адресу `ip` исполнилась за `ticks` тактов и передала управление на `next_ip`."""
+        self.ip_ticks[ip] += ticks
+        self.stacks[self.stack] += ticks
+        opcode = self.image[ip][0]
+        if opcode == machine.Opcodes.CALL:
+            name = self.entries.get(next_ip, "?{}".format(next_ip))
+            self.stack += (name,)
+            self.calls[name] += 1
+        elif opcode == machine.Opcodes.RET and len(self.stack) > 1:
+            self.stack = self.stack[:-1]
+        elif opcode == machine.Opcodes.JMP and next_ip in self.entries and len(self.stack) > 1:
+            name = self.entries[next_ip]
+            self.stack = self.stack[:-1] + (name,)
+            self.calls[name] += 1
+
+    def functions(self):
+        exclusive, inclusive = Counter(), Counter()
+        for stack, ticks in self.stacks.items():
+            exclusive[stack[-1]] += ticks
+            for name in set(stack):  # рекурсия считается один раз
+                inclusive[name] += ticks
+        return {
+            name: {"calls": self.calls[name], "inclusive": inclusive[name], "exclusive": exclusive[name]}
+            for name in sorted(inclusive, key=inclusive.get, reverse=True)
+        }
+
+    def lines(self):
+        lines = Counter()
+        for ip, ticks in self.ip_ticks.items():
+            lines[self.source_map["instructions"][ip]["line"]] += ticks
+        return dict(sorted(lines.items()))
+
+    def loops(self):
+        ticks_by_loop = Counter()
+        for ip, ticks in self.ip_ticks.items():
+            loop = self.source_map["instructions"][ip]["loop"]
+            if loop is not None:
+                ticks_by_loop[loop] += ticks
+        return {
+            "while@{}".format(loop["line"]): {
+                "function": loop["function"] or self.root,
+                "line": loop["line"],
+                "ticks": ticks_by_loop[loop["token"]],
+            }
+            for loop in self.source_map["loops"]
+        }
+
+    def collapsed(self):
+        """Строки свёрнутых стеков: `main;f;g <такты>`."""
+        return ["{} {}".format(";".join(stack), ticks) for stack, ticks in sorted(self.stacks.items()) if ticks]
+
+    def to_dict(self):
+        return {
+            "ticks": sum(self.ip_ticks.values()),
+            "functions": self.functions(),
+            "lines": {str(line): ticks for line, ticks in self.lines().items()},
+            "loops": self.loops(),
+        }
+
+
+def profile(code, source_map, input_port, engine="fast", limit=10**9, chunk=1 << 16):
+    """Исполнить программу и вернуть `(Profile, RunResult)`.
+
+    Трасса обрабатывается порциями по `chunk` инструкций, поэтому память не
+    зависит от длины исполнения.
+    """
+    trace = machine.TraceBuffer(capacity=chunk + 1)
+    model = machine.Machine(code, input_port, engine=engine, trace=trace)
+    result = Profile(model.image, source_map)
+    return result, machine.run_traced(model, trace, result.record, limit)
+
+
+def profiler(code_file, map_file, input_file, collapsed_file=None, engine="fast", limit=10**9):
+    code = machine.read_code(code_file)
+    with open(map_file, encoding="utf-8") as file:
+        source_map = json.load(file)
+    with open(input_file, "rb") as file:
+        result, run = profile(code, source_map, machine.InputPort(fd=file.fileno()), engine, limit)
+    report = result.to_dict()
+    print("reason:", run.reason, "instr_counter:", run.instructions, "ticks:", run.ticks)
+    print("{:<20} {:>8} {:>12} {:>12}".format("function", "calls", "inclusive", "exclusive"))
+    for name, function in report["functions"].items():
+        print(
+            "{:<20} {:>8} {:>12} {:>12}".format(name, function["calls"], function["inclusive"], function["exclusive"])
+        )
+    for name, loop in report["loops"].items():
+        print("{:<20} {:<20} {:>12}".format(name, loop["function"], loop["ticks"]))
+    for line, ticks in report["lines"].items():
+        print("line {:<15} {:>12}".format(line, ticks))
+    if collapsed_file is not None:
+        with open(collapsed_file, "w", encoding="utf-8") as file:
+            file.write("\n".join(result.collapsed()) + "\n")
+
+
+if __name__ == "__main__":
+    assert len(sys.argv) in (4, 5, 6), (
+        "Wrong arguments: profiler.py <code_file> <map_file> <input_file> [collapsed_file|-] [signal|fast|block]"
+    )
+    _, code_file, map_file, input_file, *rest = sys.argv
+    profiler(
+        code_file,
+        map_file,
+        input_file,
+        rest[0] if rest and rest[0] != "-" else None,
+        rest[1] if len(rest) > 1 else "fast",
+    )
@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+"""Сервер моделей процессора: по модели на соединение, все -- в одном процессе.
+
+Каждое соединение (UNIX-сокет или TCP) получает свою `machine.Machine` с
+программой `code_file`: принятые байты -- её ввод, вывод уходит обратно по
+мере исполнения. Ввод не читается заранее: модель ждёт данных на `IN`
+(`Machine.run_async`), не занимая поток. Программа загружается и
+предекодируется один раз.
+"""
+
+import asyncio
+import sys
+
+import batch
+import machine
+
+
+async def handle(program, reader, writer, engine="fast", limit=None):
+    model = machine.Machine(program, machine.InputPort(), engine=engine)
+    try:
+        await model.run_async(reader, writer, limit)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def serve(code_file, address, engine="fast", limit=None):
+    """Принимать соединения на `address`: путь UNIX-сокета или `host:port`."""
+    program = batch.load_program(code_file)
+
+    async def connected(reader, writer):
+        await handle(program, reader, writer, engine, limit)
+
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        server = await asyncio.start_server(connected, host, int(port))
+    else:
+        server = await asyncio.start_unix_server(connected, address)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    assert len(sys.argv) in (3, 4, 5), "Wrong arguments: serve.py <code_file> <socket_path|host:port> [engine] [limit]"
+    _, code_file, address, *rest = sys.argv
+    asyncio.run(serve(code_file, address, rest[0] if rest else "fast", int(rest[1]) if len(rest) > 1 else None))
@@ -0,0 +1,22 @@
+#!/usr/bin/python3
+"""Декодер двоичной трассы `machine.TraceBuffer` в текстовый журнал модели."""
+
+import sys
+
+import machine
+
+
+def tracedump(code_file, trace_file):
+    code = machine.read_code(code_file)
+    if isinstance(code, machine.PackedProgram):
+        programm = code.instructions()
+    else:
+        _, programm = machine.split_data_segment(code)
+    for line in machine.decode_trace(machine.TraceBuffer.load(trace_file), programm):
+        print(line)
+
+
+if __name__ == "__main__":
+    assert len(sys.argv) == 3, "Wrong arguments: tracedump.py <code_file> <trace_file>"
+    _, code_file, trace_file = sys.argv
+    tracedump(code_file, trace_file)
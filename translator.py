@@ -1,16 +1,36 @@
+import hashlib
+import json
+import os
 import re
 import sys
+import tempfile
+from pathlib import Path
+
+import machine
 
 
 class AST:
     def __init__(self, token_nuber: int, args: list[object]):
         self.token_nuber = token_nuber
         self.args = args
-        self.code = []
+        self.value = None  # значение, известное при трансляции (режим fold)
+
+
+token_pattern = r"[\(\)]|\"[^\"]*?\"|\'[^\']*?'|[\w\-+]+|!=|>=|\S"
 
 
 def tokenizer(program: str) -> list[str]:
-    return re.findall(r"[\(\)]|\"[^\"]*?\"|\'[^\']*?'|[\w\-+]+|!=|>=|\S", program)
+    return re.findall(token_pattern, program)
+
+
+def token_lines(program: str) -> list[int]:
+    """Номер строки (с 1) каждого токена `tokenizer(program)`."""
+    lines, line, position = [], 1, 0
+    for match in re.finditer(token_pattern, program):
+        line += program.count("\n", position, match.start())
+        position = match.start()
+        lines.append(line)
+    return lines
 
 
 # highlighting the token
@@ -53,8 +73,163 @@ def build_ast(tokens: list[str]) -> AST:
     return root
 
 
-def translate(tokens: list[str], ast: AST) -> str:
+def instruction_ticks(instr: dict) -> int:
+    """Такты одного исполнения инструкции (по таблице модели процессора)."""
+    opcode = machine.opcode_by_name.get(instr["instruction"], machine.Opcodes.NOP)
+    operand = operand_of(instr)
+    return machine.instruction_ticks.get((opcode, operand[0] if operand else None), 1)
+
+
+def operand_of(instr: dict):
+    return machine.decode_value(instr["operand"]) if "operand" in instr else None
+
+
+def same_cell(st: dict, ld: dict) -> bool:
+    """`LD` читает ту же ячейку, в которую пишет `ST` (прямые адреса и SP+n)."""
+    st_operand, ld_operand = operand_of(st), operand_of(ld)
+    return (
+        st_operand is not None
+        and ld_operand is not None
+        and (st_operand[0], ld_operand[0]) in ((0, 1), (2, 2))
+        and st_operand[1] == ld_operand[1]
+    )
+
+
+# Правила оконной оптимизации: имя -> (длина окна, замена). Замена получает
+# подряд идущие инструкции без меток между ними и возвращает список новых
+# инструкций или None. Метка перед окном после замены указывает на её начало,
+# поэтому замена должна совпадать с окном по действию на AC, SP, флаги и вывод.
+peephole_rules = {
+    # NOP только несёт метку; метка переходит на следующую инструкцию
+    "nop": (1, lambda a: [] if a["instruction"] == "NOP" else None),
+    # PUSH кладёт AC в стек, POP возвращает его же в AC
+    "push-pop": (2, lambda a, b: [] if (a["instruction"], b["instruction"]) == ("PUSH", "POP") else None),
+    # POP + PUSH оставляют SP прежним, а в AC -- вершину стека
+    "pop-push": (
+        2,
+        lambda a, b: (
+            [{"instruction": "LD", "operand": "SP+0"}]
+            if (a["instruction"], b["instruction"]) == ("POP", "PUSH")
+            else None
+        ),
+    ),
+    # после PUSH вершина стека уже равна AC
+    "push-load": (
+        2,
+        lambda a, b: (
+            [a] if a["instruction"] == "PUSH" and b["instruction"] == "LD" and operand_of(b) == (2, 0) else None
+        ),
+    ),
+    # после ST ячейка уже равна AC
+    "store-load": (
+        2,
+        lambda a, b: [a] if a["instruction"] == "ST" and b["instruction"] == "LD" and same_cell(a, b) else None,
+    ),
+    # LD не меняет флаги, а следующий LD/POP перезаписывает AC
+    "dead-load": (
+        2,
+        lambda a, b: [b] if a["instruction"] == "LD" and b["instruction"] in ("LD", "POP") else None,
+    ),
+    # JMP на следующую инструкцию обрабатывается при разборе меток
+    "jump-next": (0, None),
+}
+
+
+def peephole(code: list[dict], rules=None) -> tuple[list[dict], tuple[int, int]]:
+    """Оконная оптимизация кода до линковки.
+
+    `rules` -- имена правил из `peephole_rules` (по умолчанию все). Правила
+    применяются к хвосту результата по мере его построения, поэтому
+    срабатывают и каскадом (`LD x; PUSH; POP; LD y` -> `LD y`). Окно не
+    пересекает метку: на инструкцию с меткой можно перейти откуда угодно.
+    Метки удалённых инструкций переходят на следующую инструкцию; если на
+    одну инструкцию попадает несколько меток, переходы на лишние
+    перенаправляются на первую.
+
+    Возвращает код и экономию `(инструкций, тактов)`; такты -- оценка за одно
+    исполнение каждой удалённой инструкции.
+    """
+    rules = peephole_rules if rules is None else {name: peephole_rules[name] for name in rules}
+    windows = [(size, rule) for size, rule in rules.values() if size > 0]
+    stream = []  # инструкции (dict) и метки (str) в порядке следования
+    for instr in code:
+        instr = dict(instr)
+        if "lable" in instr:
+            label = instr.pop("lable")
+            if "jump-next" in rules:
+                drop_jump_to(stream, label)
+            stream.append(label)
+        stream.append(instr)
+        apply_windows(stream, windows)
+    result = link_labels(stream)
+    saved_ticks = sum(map(instruction_ticks, code)) - sum(map(instruction_ticks, result))
+    return result, (len(code) - len(result), saved_ticks)
+
+
+def drop_jump_to(stream: list, label: str):
+    """Удалить `JMP label` в конце потока (перед метками), если `label` ставится следующей."""
+    i = len(stream)
+    while i > 0 and isinstance(stream[i - 1], str):
+        i -= 1
+    if i > 0 and stream[i - 1]["instruction"] == "JMP" and stream[i - 1].get("V") == label:
+        del stream[i - 1]
+
+
+def apply_windows(stream: list, windows: list):
+    """Применять правила к хвосту потока, пока какое-нибудь срабатывает."""
+    changed = True
+    while changed and isinstance(stream[-1], dict):
+        changed = False
+        for size, rule in windows:
+            window = stream[-size:]
+            if len(window) == size and all(isinstance(item, dict) for item in window):
+                replacement = rule(*window)
+                if replacement is not None:
+                    stream[-size:] = replacement
+                    changed = len(stream) > 0
+                    break
+
+
+def link_labels(stream: list) -> list[dict]:
+    """Перенести метки на следующие инструкции; лишние метки одной инструкции -- на первую."""
+    result, labels, alias = [], [], {}
+    for item in stream:
+        if isinstance(item, str):
+            labels.append(item)
+            continue
+        if labels:
+            item["lable"] = labels[0]
+            alias.update((label, labels[0]) for label in labels[1:])
+            labels = []
+        result.append(item)
+    assert not labels, "Label at the end of the program"
+    for instr in result:
+        if instr.get("V") in alias:
+            instr["V"] = alias[instr["V"]]
+    return result
+
+
+# Оптимизации, включаемые при трансляции (по умолчанию выключены)
+optimizations = ("fold", "acc", "tco", "peephole")
+
+
+def translate(tokens: list[str], ast: AST, enabled=(), report=None, source_map=None) -> str:
+    """Транслировать AST в машинный код: `[сегмент данных, инструкции...]`.
+
+    `enabled` -- включённые оптимизации из `optimizations`, в `report` (dict)
+    записывается их экономия. Если передан `source_map` (dict), в него
+    записывается карта исходного кода, см. `locate_source`.
+    """
     global_data = []
+    # Общий буфер инструкций: `compile` дописывает код узлов по ходу обхода,
+    # поэтому каждая инструкция создаётся и копируется один раз.
+    code = []
+    acc = "acc" in enabled  # значение выражения держится в AC, листья -- операнды АЛУ
+    fold = "fold" in enabled  # свёртка констант и удаление недостижимого кода до компиляции
+    tco = "tco" in enabled  # хвостовые вызовы в defun -- JMP вместо CALL
+    arities = {}  # метка функции -> число аргументов
+    context = (None, None)  # (функция, цикл), в которых компилируется узел; только для source_map
+    defuns, loops = [], []  # скомпилированные функции и циклы: (имя, номер токена), (номер токена, функция)
 
     def t_assert(q: bool, text: str, ast: AST):
         if not q:
@@ -98,44 +273,255 @@ def translate(tokens: list[str], ast: AST) -> str:
             ]
         )
 
-    def compile_str(name: str, scope: dict[str, (str, int)]) -> list[str]:  # string, varible, number
+    def leaf_operand(name: str, scope: dict[str, (str, int)]) -> str:  # string, varible, number
         if t_is(name, "variable"):
             if name not in scope:
                 print(name + " is undefined")
                 exit(1)
             if scope[name][0] == "variable":
-                return [
-                    {"instruction": "LD", "operand": "[" + str(scope[name][1]) + "]"},
-                    {"instruction": "PUSH"},
-                ]
+                return "[" + str(scope[name][1]) + "]"
             print(name + " isn't variable")
             exit(1)
         if t_is(name, "string"):
             ind = len(global_data)
             global_data.extend([ord(c) for c in name[1:-1]])
             global_data.append(0)
-            return [{"instruction": "LD", "operand": str(ind)}, {"instruction": "PUSH"}]
+            return str(ind)
         if t_is(name, "number"):
-            return [
-                {"instruction": "LD", "operand": str(name)},
-                {"instruction": "PUSH"},
-            ]
+            return str(name)
         print("Unknown token: " + name)
         exit(1)
 
-    def compile(ast: AST, scope: dict[str, (str, int)]):
+    def compile_str(name: str, scope: dict[str, (str, int)]) -> list[str]:
+        return [{"instruction": "LD", "operand": leaf_operand(name, scope)}, {"instruction": "PUSH"}]
+
+    def compile_to_ac(arg, scope: dict[str, (str, int)]):
+        """Значение аргумента в AC, без сохранения в стек."""
+        if not isinstance(arg, AST):
+            code.append({"instruction": "LD", "operand": leaf_operand(arg, scope)})
+            return
+        compile(arg, scope)
+        last = code[-1]
+        if last["instruction"] != "PUSH":
+            code.append({"instruction": "POP"})
+        elif "lable" in last:  # на PUSH переходят: значение в AC на всех путях
+            code[-1] = {"instruction": "NOP", "lable": last["lable"]}
+        else:
+            code.pop()
+
+    def compile_condition(arg, scope: dict[str, (str, int)]):
+        """Значение условия на вершину стека и в AC."""
+        if acc:
+            compile_to_ac(arg, scope)
+            code.append({"instruction": "PUSH"})
+            return
+        if isinstance(arg, AST):
+            compile(arg, scope)
+        else:
+            code.extend(compile_str(arg, scope))
+        code.append({"instruction": "LD", "operand": "SP+0"})
+
+    def t_pure(arg) -> bool:
+        """Выражение только читает память: его можно вычислить раньше соседей."""
+        if not isinstance(arg, AST):
+            return True
+        return (
+            len(arg.args) > 0
+            and not isinstance(arg.args[0], AST)
+            and arg.args[0] in ("=", ">=", "!=", "+", "-", "*", "/", "%", "getv")
+            and all(t_pure(x) for x in arg.args[1:])
+        )
+
+    def compile_binary_acc(ast: AST, scope: dict[str, (str, int)]) -> bool:
+        """Бинарная операция с листом-операндом через AC (режим `acc`).
+
+        Лист берётся прямым или непосредственным операндом АЛУ, в стек
+        попадает только результат. Возвращает False, если оба операнда --
+        выражения, тогда используется обычный стековый код.
+        """
+        op, left, right = ast.args
+        alu = {"+": "ADD", "-": "SUB", "*": "MUL", "/": "DIV", "%": "MOD"}.get(op, "CMP")
+        result = {"instruction": "PUSH"}
+        if not isinstance(right, AST):
+            compile_to_ac(left, scope)
+            operand = leaf_operand(right, scope)
+        elif not isinstance(left, AST) and t_pure(right):
+            if op in ("+", "*"):
+                compile_to_ac(right, scope)
+                operand = leaf_operand(left, scope)
+            else:
+                compile(right, scope)
+                code.append({"instruction": "LD", "operand": leaf_operand(left, scope)})
+                operand = "[SP+0]"
+                result = {"instruction": "ST", "operand": "SP+0"}
+        else:
+            return False
+        code.append({"instruction": alu, "operand": operand})
+        if alu == "CMP":
+            lable = rnd_lable()
+            code.append({"instruction": "LD", "operand": "1"})
+            code.append({"instruction": {"=": "JE", "!=": "JNE", ">=": "JGE"}[op], "V": lable})
+            code.append({"instruction": "LD", "operand": "0"})
+            result["lable"] = lable
+        code.append(result)
+        return True
+
+    builtins = ("setq", "defvar", "setv", "IN", "compile-malloc", "getv", "OUT", "defun", "while", "if")
+    binary = {
+        "+": lambda a, b: a + b,
+        "-": lambda a, b: a - b,
+        "*": lambda a, b: a * b,
+        "/": lambda a, b: a // b if b != 0 else None,  # как DIV: с округлением вниз, /0 -- во время исполнения
+        "%": lambda a, b: a % b if b != 0 else None,
+        "=": lambda a, b: int(a == b),
+        ">=": lambda a, b: int(a >= b),
+        "!=": lambda a, b: int(a != b),
+    }
+    # аргументы, вместо которых можно подставить число: они компилируются и как выражение, и как лист
+    literal_args = {"setq": 2, "defvar": 2, "setv": 2, "getv": 1, "OUT": 1, "while": 1, "if": 1}
+
+    def t_literal(value) -> bool:
+        return value is not None and -0x8000 <= value <= 0x7FFF  # помещается в непосредственный операнд
+
+    def literal_positions(node: AST):
+        """Номера аргументов узла, вместо которых можно подставить число."""
+        head = node.args[0]
+        if head in binary or (head not in builtins and t_is(head, "variable")):  # операция или вызов функции
+            return range(1, len(node.args))
+        if head in literal_args and len(node.args) > literal_args[head]:
+            return [literal_args[head]]
+        return []
+
+    def has_definitions(node) -> bool:
+        """В поддереве есть `defvar`/`defun`: их имена видны и после него, даже если оно не исполняется."""
+        if not isinstance(node, AST) or len(node.args) == 0:
+            return False
+        return node.args[0] in ("defvar", "defun") or any(has_definitions(arg) for arg in node.args)
+
+    def fold_constants(node) -> int:
+        """Свёртка констант (режим `fold`): значение узла, если оно известно до исполнения.
+
+        Числа ведут себя как `LD n` (обрезка до int16), операции -- как АЛУ
+        (int32, деление с округлением вниз). Вычисленное значение сохраняется
+        в `node.value`, константные аргументы заменяются числами. `if`/`while`
+        с ложным условием сводятся к значению условия (0), если в теле нет
+        определений.
+        """
+        if not isinstance(node, AST):
+            return machine.crop_int_to_int16(int(node)) if t_is(node, "number") else None
+        values = [fold_constants(arg) for arg in node.args]
+        if len(node.args) == 0 or isinstance(node.args[0], AST):
+            return None
+        head = node.args[0]
+        for i in literal_positions(node):
+            if isinstance(node.args[i], AST) and t_literal(values[i]):
+                node.args[i] = str(values[i])
+        if head in binary and len(node.args) == 3 and None not in values[1:]:
+            value = binary[head](values[1], values[2])
+            node.value = machine.crop_int_to_int32(value) if value is not None else None
+        elif head in ("if", "while") and len(node.args) > 2 and values[1] == 0:
+            node.value = None if any(has_definitions(arg) for arg in node.args[2:]) else 0
+        return node.value
+
+    def visit_calls(node, nodes: list, called: set, defuns: list):
+        """Шаг обхода `drop_unused_functions`: `defun` откладывается, вызовы запоминаются."""
+        if not isinstance(node, AST) or len(node.args) == 0 or t_literal(node.value):
+            return
+        head = node.args[0]
+        if head == "defun" and len(node.args) > 3 and not isinstance(node.args[1], AST):
+            defuns.append(node)
+            return
+        if not isinstance(head, AST) and head not in builtins and t_is(head, "variable"):
+            called.add(head)
+        nodes.extend(node.args)
+
+    def drop_unused_functions(root: AST):
+        """Функции, которые не вызываются из достижимого кода, не компилируются (режим `fold`).
+
+        Достижимость считается по именам: от корня, минуя свёрнутые узлы, и
+        далее по телам вызванных функций. Невызванный `defun` получает
+        значение 1 -- то, что оставляет на стеке сам `defun`.
+        """
+        called, defuns, live = set(), [], set()
+        nodes = [root]
+        while nodes:
+            visit_calls(nodes.pop(), nodes, called, defuns)
+            if not nodes:
+                for defun in defuns:
+                    if id(defun) not in live and defun.args[1] in called:
+                        live.add(id(defun))
+                        nodes.extend(defun.args[3:])
+        for defun in defuns:
+            if id(defun) not in live:
+                defun.value = 1
+
+    def tail_call(ast: AST, scope: dict[str, (str, int)], tail) -> bool:
+        """Вызов в хвостовой позиции функции `tail = (имя, метка, число аргументов)` (режим `tco`).
+
+        Новые аргументы записываются на место аргументов текущего вызова, и
+        вместо `CALL` выполняется `JMP` в начало функции: она вернётся прямо
+        к вызвавшему, стек не растёт. Так компилируются вызовы самой функции
+        (без `tco` её имя в теле не определено) и других функций с тем же
+        числом аргументов. Возвращает False, если вызов не подходит.
+        """
+        name, lable, arity = tail
+        if ast.args[0] not in scope:
+            target = lable if ast.args[0] == name else None
+        else:
+            target = scope[ast.args[0]][1] if scope[ast.args[0]][0] == "function" else None
+        if target is None or arities.get(target) != arity or len(ast.args) - 1 != arity:
+            return False
+        for arg in ast.args[1:]:
+            if isinstance(arg, AST):
+                compile(arg, scope)
+            else:
+                code.extend(compile_str(arg, scope))
+        for i in range(arity):  # последний аргумент -- на вершине, его место всегда SP+arity
+            code.append({"instruction": "POP"})
+            code.append({"instruction": "ST", "operand": "SP+" + str(arity)})
+        code.append({"instruction": "JMP", "V": "lable_f" + str(target)})
+        return True
+
+    def compile(ast: AST, scope: dict[str, (str, int)], tail=None):
+        """Скомпилировать узел; для карты исходного кода пометить его инструкции.
+
+        Вложенные узлы компилируются раньше, поэтому инструкция помечается
+        самым глубоким узлом, который её породил. Метка `token` снимается
+        при построении карты, как `lable` при линковке.
+        """
+        nonlocal context
+        if source_map is None:
+            compile_node(ast, scope, tail)
+            return
+        outer = context
+        if ast.args and ast.args[0] == "defun" and not t_literal(ast.value):
+            defuns.append((ast.args[1], ast.token_nuber))
+            context = (ast.args[1], None)
+        elif ast.args and ast.args[0] == "while":
+            loops.append((ast.token_nuber, context[0]))
+            context = (context[0], ast.token_nuber)
+        start = len(code)
+        compile_node(ast, scope, tail)
+        for instr in code[start:]:
+            instr.setdefault("token", (ast.token_nuber,) + context)
+        context = outer
+
+    def compile_node(ast: AST, scope: dict[str, (str, int)], tail=None):
         t_assert(len(ast.args) != 0, "Empty parentheses", ast)
+        if t_literal(ast.value):
+            if ast.args[0] == "defun":  # имя функции остаётся определённым
+                t_define(ast.args[1], "function", scope, ast.token_nuber)
+            code.extend(compile_str(str(ast.value), scope))
+            return
         if isinstance(ast.args[0], AST) or t_is(ast.args[0], "string"):  # ((code) (code) (code) ...)
             for arg in ast.args[:-1]:
                 if isinstance(arg, AST):
                     compile(arg, scope)
-                    ast.code.extend(arg.code)
-                    ast.code.append({"instruction": "POP"})
+                    code.append({"instruction": "POP"})
             if isinstance(ast.args[-1], AST):
-                compile(ast.args[-1], scope)
-                ast.code.extend(ast.args[-1].code)
+                compile(ast.args[-1], scope, tail)
             else:
-                ast.code.extend(compile_str(ast.args[-1], scope))
+                code.extend(compile_str(ast.args[-1], scope))
         elif ast.args[0] in ("setq", "defvar", "setv"):
             t_assert(len(ast.args) == 3, "setq expects 2 arguments", ast)
             t_assert(
@@ -150,15 +536,19 @@ def translate(tokens: list[str], ast: AST) -> str:
                 ast.args[1] + " is not variable",
                 ast,
             )
+            if acc:  # значение остаётся и в AC, и на вершине стека
+                compile_to_ac(ast.args[2], scope)
+                code.append({"instruction": "PUSH"})
+                code.extend(set_varible(ast.args[1], scope, ast.args[0] == "setv")[1:])
+                return
             if isinstance(ast.args[2], AST):
                 compile(ast.args[2], scope)
-                ast.code.extend(ast.args[2].code)
             else:
-                ast.code.extend(compile_str(ast.args[2], scope))
-            ast.code.extend(set_varible(ast.args[1], scope, ast.args[0] == "setv"))
+                code.extend(compile_str(ast.args[2], scope))
+            code.extend(set_varible(ast.args[1], scope, ast.args[0] == "setv"))
         elif ast.args[0] == "IN":
             t_assert(len(ast.args) == 1, ast.args[0] + " expects 0 arguments", ast)
-            ast.code.extend([{"instruction": "IN"}, {"instruction": "PUSH"}])
+            code.extend([{"instruction": "IN"}, {"instruction": "PUSH"}])
         elif ast.args[0] == "compile-malloc":
             t_assert(len(ast.args) == 2, ast.args[0] + " expects 1 arguments", ast)
             t_assert(
@@ -166,7 +556,7 @@ def translate(tokens: list[str], ast: AST) -> str:
                 ast.args[0] + " expects a number as the first argument",
                 ast,
             )
-            ast.code.extend(
+            code.extend(
                 [
                     {"instruction": "LD", "operand": str(len(global_data))},
                     {"instruction": "PUSH"},
@@ -176,66 +566,70 @@ def translate(tokens: list[str], ast: AST) -> str:
                 global_data.append(0)
         elif ast.args[0] in ("getv", "OUT"):
             t_assert(len(ast.args) == 2, ast.args[0] + " expects 1 argument", ast)
+            if acc and ast.args[0] == "OUT":
+                compile_to_ac(ast.args[1], scope)
+                code.extend([{"instruction": "PUSH"}, {"instruction": "OUT"}])
+                return
             if isinstance(ast.args[1], AST):
                 compile(ast.args[1], scope)
-                ast.code.extend(ast.args[1].code)
             else:
-                ast.code.extend(compile_str(ast.args[1], scope))
+                code.extend(compile_str(ast.args[1], scope))
             if ast.args[0] == "getv":
-                ast.code.extend(
+                code.extend(
                     [
                         {"instruction": "LD", "operand": "[SP+0]"},
                         {"instruction": "ST", "operand": "SP+0"},
                     ]
                 )
             else:
-                ast.code.extend([{"instruction": "LD", "operand": "SP+0"}, {"instruction": "OUT"}])
+                code.extend([{"instruction": "LD", "operand": "SP+0"}, {"instruction": "OUT"}])
         elif ast.args[0] in ("=", ">=", "!=", "+", "-", "*", "/", "%"):
             t_assert(len(ast.args) == 3, ast.args[0] + " expects 2 arguments", ast)
+            if acc and compile_binary_acc(ast, scope):
+                return
             for arg in ast.args[1:]:
                 if isinstance(arg, AST):
                     compile(arg, scope)
-                    ast.code.extend(arg.code)
                 else:
-                    ast.code.extend(compile_str(arg, scope))
+                    code.extend(compile_str(arg, scope))
             if ast.args[0] in ("+", "*"):
-                ast.code.append({"instruction": "POP"})
-                ast.code.append(
+                code.append({"instruction": "POP"})
+                code.append(
                     {
                         "instruction": ({"+": "ADD", "*": "MUL"}[ast.args[0]]),
                         "operand": "[SP+0]",
                     }
                 )
-                ast.code.append({"instruction": "ST", "operand": "SP+0"})
+                code.append({"instruction": "ST", "operand": "SP+0"})
             if ast.args[0] in ("-", "/", "%"):
-                ast.code.append({"instruction": "LD", "operand": "SP+1"})
-                ast.code.append(
+                code.append({"instruction": "LD", "operand": "SP+1"})
+                code.append(
                     {
                         "instruction": ({"-": "SUB", "/": "DIV", "%": "MOD"}[ast.args[0]]),
                         "operand": "[SP+0]",
                     }
                 )
-                ast.code.append({"instruction": "ST", "operand": "SP+1"})
-                ast.code.append({"instruction": "POP"})
+                code.append({"instruction": "ST", "operand": "SP+1"})
+                code.append({"instruction": "POP"})
             if ast.args[0] in ("=", ">=", "!="):
                 lable1 = rnd_lable()
                 lable2 = rnd_lable()
-                ast.code.append({"instruction": "LD", "operand": "SP+1"})
-                ast.code.append({"instruction": "CMP", "operand": "[SP+0]"})
-                ast.code.append(
+                code.append({"instruction": "LD", "operand": "SP+1"})
+                code.append({"instruction": "CMP", "operand": "[SP+0]"})
+                code.append(
                     {
                         "instruction": ({"=": "JE", "!=": "JNE", ">=": "JGE"}[ast.args[0]]),
                         "V": lable1,
                     }
                 )
-                ast.code.append({"instruction": "LD", "operand": "0"})
-                ast.code.append({"instruction": "JMP", "V": lable2})
-                ast.code.append({"instruction": "LD", "operand": "1", "lable": lable1})
-                ast.code.append({"instruction": "ST", "operand": "SP+1", "lable": lable2})
-                ast.code.append({"instruction": "POP"})
+                code.append({"instruction": "LD", "operand": "0"})
+                code.append({"instruction": "JMP", "V": lable2})
+                code.append({"instruction": "LD", "operand": "1", "lable": lable1})
+                code.append({"instruction": "ST", "operand": "SP+1", "lable": lable2})
+                code.append({"instruction": "POP"})
         elif ast.args[0] == "defun":
             lable1 = rnd_lable()
-            ast.code.append({"instruction": "JMP", "V": lable1})
+            code.append({"instruction": "JMP", "V": lable1})
             t_assert(
                 len(ast.args) > 3,
                 ast.args[0] + " expects more 3 arguments (name, arguments, ...body)",
@@ -255,16 +649,17 @@ def translate(tokens: list[str], ast: AST) -> str:
             t_assert(len(ast.args[2].args) > 0, "Еxpects one or more arguments", ast)
             fscope = dict(filter(lambda x: x[1][0] != "arg_variable", scope.items()))
             t_define(ast.args[1], "function", scope, ast.token_nuber)
-            ast.code.append({"instruction": "NOP", "lable": "lable_f" + str(ast.token_nuber)})
+            arities[ast.token_nuber] = len(ast.args[2].args)
+            code.append({"instruction": "NOP", "lable": "lable_f" + str(ast.token_nuber)})
             for i in range(len(ast.args[2].args)):
                 t_define(ast.args[2].args[i], "variable", fscope)
-                ast.code.append(
+                code.append(
                     {
                         "instruction": "LD",
                         "operand": "SP+" + str(len(ast.args[2].args) - i),
                     }
                 )
-                ast.code.append(
+                code.append(
                     {
                         "instruction": "ST",
                         "operand": str(fscope[ast.args[2].args[i]][1]),
@@ -273,18 +668,16 @@ def translate(tokens: list[str], ast: AST) -> str:
             for arg in ast.args[3:-1]:
                 if isinstance(arg, AST):
                     compile(arg, fscope)
-                    ast.code.extend(arg.code)
-                    ast.code.append({"instruction": "POP"})
+                    code.append({"instruction": "POP"})
             if isinstance(ast.args[-1], AST):
-                compile(ast.args[-1], fscope)
-                ast.code.extend(ast.args[-1].code)
+                compile(ast.args[-1], fscope, (ast.args[1], ast.token_nuber, len(ast.args[2].args)) if tco else None)
             else:
-                ast.code.extend(compile_str(ast.args[-1], fscope))
-            ast.code.append({"instruction": "POP"})
-            ast.code.append({"instruction": "ST", "operand": "SP+" + str(len(ast.args[2].args))})
-            ast.code.append({"instruction": "RET"})
-            ast.code.append({"instruction": "LD", "operand": "1", "lable": lable1})
-            ast.code.append({"instruction": "PUSH"})
+                code.extend(compile_str(ast.args[-1], fscope))
+            code.append({"instruction": "POP"})
+            code.append({"instruction": "ST", "operand": "SP+" + str(len(ast.args[2].args))})
+            code.append({"instruction": "RET"})
+            code.append({"instruction": "LD", "operand": "1", "lable": lable1})
+            code.append({"instruction": "PUSH"})
         elif ast.args[0] in ("while", "if"):
             t_assert(
                 len(ast.args) > 2,
@@ -294,39 +687,40 @@ def translate(tokens: list[str], ast: AST) -> str:
             if ast.args[0] == "while":
                 lable1 = rnd_lable()
                 lable2 = rnd_lable()
-                ast.code.append({"instruction": "NOP", "lable": lable1})
-                if isinstance(ast.args[1], AST):
-                    compile(ast.args[1], scope)
-                    ast.code.extend(ast.args[1].code)
-                else:
-                    ast.code.extend(compile_str(ast.args[1], scope))
-                ast.code.append({"instruction": "LD", "operand": "SP+0"})
-                ast.code.append({"instruction": "CMP", "operand": "0"})
-                ast.code.append({"instruction": "JE", "V": lable2})
-                ast.code.append({"instruction": "POP"})
+                code.append({"instruction": "NOP", "lable": lable1})
+                compile_condition(ast.args[1], scope)
+                code.append({"instruction": "CMP", "operand": "0"})
+                code.append({"instruction": "JE", "V": lable2})
+                code.append({"instruction": "POP"})
                 for arg in ast.args[2:]:
                     if isinstance(arg, AST):
                         compile(arg, scope)
-                        ast.code.extend(arg.code)
-                        ast.code.append({"instruction": "POP"})
-                ast.code.append({"instruction": "JMP", "V": lable1})
-                ast.code.append({"instruction": "NOP", "lable": lable2})
+                        code.append({"instruction": "POP"})
+                code.append({"instruction": "JMP", "V": lable1})
+                code.append({"instruction": "NOP", "lable": lable2})
+            elif (
+                ast.args[0] == "if"
+                and fold
+                and isinstance(ast.args[1], str)
+                and t_is(ast.args[1], "number")
+                and ast.args[1] != "0"
+            ):
+                # условие истинно: остаётся тело (ложное без определений свёрнуто в fold_constants)
+                for arg in ast.args[2:]:
+                    if isinstance(arg, AST):
+                        compile(arg, scope, tail if len(ast.args) == 3 else None)
             elif ast.args[0] == "if":
                 lable1 = rnd_lable()
-                if isinstance(ast.args[1], AST):
-                    compile(ast.args[1], scope)
-                    ast.code.extend(ast.args[1].code)
-                else:
-                    ast.code.extend(compile_str(ast.args[1], scope))
-                ast.code.append({"instruction": "LD", "operand": "SP+0"})
-                ast.code.append({"instruction": "CMP", "operand": "0"})
-                ast.code.append({"instruction": "JE", "V": lable1})
-                ast.code.append({"instruction": "POP"})
+                compile_condition(ast.args[1], scope)
+                code.append({"instruction": "CMP", "operand": "0"})
+                code.append({"instruction": "JE", "V": lable1})
+                code.append({"instruction": "POP"})
                 for arg in ast.args[2:]:
-                    if isinstance(arg, AST):
-                        compile(arg, scope)
-                        ast.code.extend(arg.code)
-                ast.code.append({"instruction": "NOP", "lable": lable1})
+                    if isinstance(arg, AST):  # единственное выражение тела -- в хвостовой позиции
+                        compile(arg, scope, tail if len(ast.args) == 3 else None)
+                code.append({"instruction": "NOP", "lable": lable1})
+        elif tail is not None and tail_call(ast, scope, tail):
+            pass
         else:
             t_assert(ast.args[0] in scope, "Unknown token", ast)
             t_assert(
@@ -337,12 +731,11 @@ def translate(tokens: list[str], ast: AST) -> str:
             for arg in ast.args[1:]:
                 if isinstance(arg, AST):
                     compile(arg, scope)
-                    ast.code.extend(arg.code)
                 else:
-                    ast.code.extend(compile_str(arg, scope))
-            ast.code.append({"instruction": "CALL", "V": "lable_f" + str(scope[ast.args[0]][1])})
+                    code.extend(compile_str(arg, scope))
+            code.append({"instruction": "CALL", "V": "lable_f" + str(scope[ast.args[0]][1])})
             for i in range(len(ast.args[1:]) - 1):
-                ast.code.append({"instruction": "POP"})
+                code.append({"instruction": "POP"})
 
     def link(asm: list[dict[str, str]]):
         labels = {}
@@ -356,8 +749,36 @@ def translate(tokens: list[str], ast: AST) -> str:
                 instr["V"] = labels[instr["V"]]
         return asm
 
+    def build_source_map(asm: list[dict]):
+        """Снять метки `token` с инструкций и заполнить `source_map` (до линковки)."""
+        instructions, origin = [], (ast.token_nuber, None, None)
+        entries = {}
+        for i, instr in enumerate(asm):
+            # инструкции, созданные оконной оптимизацией, относятся к предыдущей
+            origin = instr.pop("token", origin)
+            instructions.append({"token": origin[0], "function": origin[1], "loop": origin[2]})
+            if "lable" in instr:
+                entries[instr["lable"]] = i
+        source_map["instructions"] = instructions
+        source_map["functions"] = [
+            {"name": name, "token": token, "entry": entries["lable_f" + str(token)]}
+            for name, token in defuns
+            if "lable_f" + str(token) in entries
+        ]
+        source_map["loops"] = [{"token": token, "function": function} for token, function in loops]
+
+    if fold:
+        fold_constants(ast)
+        drop_unused_functions(ast)
     compile(ast, {})
-    return [global_data] + link(ast.code + [{"instruction": "HALT"}])
+    code.append({"instruction": "HALT"})
+    if "peephole" in enabled:
+        code, saved = peephole(code)
+        if report is not None:
+            report["peephole"] = saved
+    if source_map is not None:
+        build_source_map(code)
+    return [global_data] + link(code)
 
 
 """
@@ -374,26 +795,152 @@ def print_ast(node: AST, depth=0):
 """
 
 
-def write_code(file_path, code):
-    import json
+def locate_source(source_map: dict, program: str) -> dict:
+    """Дополнить карту исходного кода номерами строк `program`.
+
+    Карта: `instructions` -- по элементу на инструкцию (индекс -- адрес в
+    памяти команд): токен, строка, объемлющие `defun` и `while` (номер
+    токена цикла); `functions` -- имя, токен, строка и адрес входа каждой
+    функции; `loops` -- токен, строка и функция каждого цикла.
+    """
+    lines = token_lines(program)
+    for item in source_map["instructions"] + source_map["functions"] + source_map["loops"]:
+        item["line"] = lines[item["token"]] if item["token"] < len(lines) else lines[-1]
+    return source_map
 
+
+def write_code(file_path, code):
+    """Записать программу: `.bin` -- упакованный двоичный формат, иначе JSON."""
+    if file_path.endswith(".bin"):
+        machine.write_packed(file_path, code)
+        return
     with open(file_path, "w") as file:
         json.dump(code, file)
 
 
-def translate_code(source, target):
+class CompileCache:
+    """
+    Дисковый кэш результатов `translate_code`.
+
+    Ключ -- sha256 исходного текста, версии транслятора (содержимого
+    `translator.py` и `machine.py`), включённых оптимизаций и формата
+    результата. Запись -- строка JSON с тем, что печатает транслятор, и
+    байты целевого файла. Время изменения записи обновляется при каждом
+    попадании; когда суммарный размер превышает `max_bytes`, удаляются
+    давно не использованные записи (LRU).
+
+    Кэшируется программа целиком: транслятор распределяет сегмент данных и
+    метки на всю программу сразу, так что отдельная функция не переносима
+    между программами.
+    """
+
+    version = None
+
+    def __init__(self, path, max_bytes=64 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        Path(path).mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def translator_version(cls):
+        if cls.version is None:
+            digest = hashlib.sha256()
+            for module in (__file__, machine.__file__):
+                with open(module, "rb") as file:
+                    digest.update(file.read())
+            cls.version = digest.hexdigest()
+        return cls.version
+
+    def key(self, source, enabled, binary):
+        text = json.dumps([self.translator_version(), sorted(enabled), binary, source])
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """`(meta, target bytes)` или None."""
+        name = os.path.join(self.path, key)
+        try:
+            with open(name, "rb") as file:
+                meta = json.loads(file.readline())
+                data = file.read()
+            os.utime(name)
+        except (OSError, ValueError):
+            return None
+        return meta, data
+
+    def put(self, key, meta, data):
+        fd, temp = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(json.dumps(meta).encode("utf-8") + b"\n")
+            file.write(data)
+        Path(temp).replace(os.path.join(self.path, key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.startswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            Path(path).unlink(missing_ok=True)  # может быть удалена другим процессом
+            total -= size
+
+
+def translate_code(source, target, enabled=(), cache=None, map_file=None):
+    """Транслировать файл `source` в `target`; `cache` -- `CompileCache` или None.
+
+    `map_file` -- куда записать карту исходного кода (JSON, см. `locate_source`).
+    """
     with open(source, encoding="utf-8") as f:
         source = f.read()
 
-    tokens = tokenizer(source)
-    ast = build_ast(tokens)
-    asm = translate(tokens, ast)
-
-    write_code(target, asm)
-    print("source LoC:", len(source.split("\n")), "code instr:", len(asm))
+    key = cache.key(source, enabled, target.endswith(".bin")) if cache is not None else None
+    hit = cache.get(key) if cache is not None else None
+    if hit is not None and (map_file is None or "source_map" in hit[0]):
+        meta, data = hit
+        with open(target, "wb") as file:
+            file.write(data)
+    else:
+        tokens = tokenizer(source)
+        ast = build_ast(tokens)
+        report = {}
+        source_map = {} if map_file is not None else None
+        asm = translate(tokens, ast, enabled, report, source_map)
+
+        write_code(target, asm)
+        meta = {"loc": len(source.split("\n")), "instr": len(asm), "report": report}
+        if source_map is not None:
+            meta["source_map"] = locate_source(source_map, source)
+        if cache is not None:
+            with open(target, "rb") as file:
+                cache.put(key, meta, file.read())
+    if map_file is not None:
+        with open(map_file, "w", encoding="utf-8") as file:
+            json.dump(meta["source_map"], file)
+    print("source LoC:", meta["loc"], "code instr:", meta["instr"])
+    for name, (instructions, ticks) in meta["report"].items():
+        print(name + ":", "saved instr:", instructions, "ticks:", ticks)
 
 
 if __name__ == "__main__":
-    assert len(sys.argv) == 3, "Wrong arguments: translator.py <input_file> <target_file>"
-    _, source, target = sys.argv
-    translate_code(source, target)
+    assert len(sys.argv) >= 3, (
+        "Wrong arguments: translator.py <input_file> <target_file> [-O[name,...]] [--cache=dir] [--map=file]"
+    )
+    _, source, target, *flags = sys.argv
+    enabled = ()
+    cache = None
+    map_file = None
+    for flag in flags:
+        if flag.startswith("--cache="):
+            cache = CompileCache(flag[len("--cache=") :])
+            continue
+        if flag.startswith("--map="):
+            map_file = flag[len("--map=") :]
+            continue
+        assert flag.startswith("-O"), "Unknown option: " + flag
+        enabled = flag[2:].split(",") if flag != "-O" else optimizations
+        assert all(name in optimizations for name in enabled), "Unknown optimization: " + flag
+    translate_code(source, target, enabled, cache, map_file)
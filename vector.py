@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+"""Одна программа на многих входах: модель процессора на массивах NumPy.
+
+Регистры (IP, AC, SP, флаги, такты, счётчик инструкций) и память данных
+каждого входа -- строка (дорожка) массивов. На каждом шаге исполняются все
+дорожки, стоящие на наименьшем IP: одна инструкция выполняется векторными
+операциями сразу для всех, остальные дорожки ждут. Дорожки, ушедшие по
+другой ветви, догоняют остальных, потому что отстающие (меньший IP: тело
+цикла, функции перед местом вызова) исполняются первыми. Остановленные
+(`HALT`, ошибка, нет ввода для `IN`, исчерпан лимит) исключаются.
+
+Результат каждой дорожки -- как у `machine.simulation`: вывод, число
+инструкций и тактов (семантика `FastEngine`: обрезка до int32, деление с
+округлением вниз, такты по `machine.instruction_ticks`). Накладные расходы
+интерпретатора платятся один раз на шаг, а не на каждый вход.
+
+NumPy -- необязательная зависимость (`poetry install -E vector`).
+"""
+
+import json
+import sys
+
+import machine
+
+try:
+    import numpy as np
+except ImportError:  # модуль импортируется и без NumPy, но модель недоступна
+    np = None
+
+Opcodes = machine.Opcodes
+StopReasons = machine.StopReasons
+
+
+def crop32(values):
+    return ((values + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+
+class VectorEngine:
+    """
+    Модель процессора на `len(inputs)` дорожек.
+
+    `inputs` -- токены ввода каждой дорожки (как для `machine.InputPort`).
+    Память -- `int64[дорожки, data_memory_size]`, поэтому на 1000 слов и
+    10000 дорожек нужно 80 МБ.
+    """
+
+    def __init__(self, code, inputs, data_memory_size=1000):
+        assert np is not None, "VectorEngine needs NumPy"
+        if isinstance(code, (machine.PackedProgram, machine.DecodedProgram)):
+            data, image = code.data, code.image()
+        else:
+            data, programm = machine.split_data_segment(code)
+            image = machine.decode_program(programm)
+        self.image = [machine.FastEngine.normalize(opcode, mode, value) for opcode, mode, value in image]
+        memory = machine.MemoryManager(data_memory_size)
+        memory.load(0, data)
+        lanes = len(inputs)
+        self.size = data_memory_size
+        self.memory = np.tile(np.array(memory.memory, dtype=np.int64), (lanes, 1))
+        self.ip = np.zeros(lanes, dtype=np.int64)
+        self.ac = np.zeros(lanes, dtype=np.int64)
+        self.sp = np.zeros(lanes, dtype=np.int64)
+        self.z = np.ones(lanes, dtype=bool)
+        self.s = np.zeros(lanes, dtype=bool)
+        self.ticks = np.zeros(lanes, dtype=np.int64)
+        self.instructions = np.zeros(lanes, dtype=np.int64)
+        self.active = np.ones(lanes, dtype=bool)
+        self.reasons = [None] * lanes
+        self.faults = [None] * lanes
+        width = max([len(tokens) for tokens in inputs] + [1])
+        self.input = np.zeros((lanes, width), dtype=np.int64)
+        for lane, tokens in enumerate(inputs):
+            self.input[lane, : len(tokens)] = tokens
+        self.input_size = np.array([len(tokens) for tokens in inputs], dtype=np.int64)
+        self.input_position = np.zeros(lanes, dtype=np.int64)
+        self.output = [machine.OutputPort() for _ in range(lanes)]
+
+    def address(self, values):
+        return crop32(values) % self.size
+
+    def stop(self, lanes, reason, fault=None):
+        self.active[lanes] = False
+        for lane in lanes.tolist():
+            self.reasons[lane] = reason
+            self.faults[lane] = fault
+
+    def run(self, limit):
+        """Исполнять, пока на каждой дорожке не исполнено `limit` инструкций или она не остановилась."""
+        size = len(self.image)
+        while True:
+            finished = self.active & (self.instructions >= limit)
+            if finished.any():
+                self.stop(np.flatnonzero(finished), StopReasons.INSTRUCTIONS)
+            invalid = self.active & ((self.ip < 0) | (self.ip >= size))
+            if invalid.any():
+                self.stop(np.flatnonzero(invalid), StopReasons.FAULT, "Unexpected end of the program")
+            if not self.active.any():
+                return
+            ip = int(self.ip[self.active].min())
+            lanes = np.flatnonzero(self.active & (self.ip == ip))
+            self.step(lanes, *self.image[ip])
+
+    def step(self, lanes, op, mode, v):  # noqa: C901 -- одна инструкция на всех дорожках
+        mem, ac, sp, tick = self.memory, self.ac, self.sp, self.ticks
+        ip = self.ip[lanes] + 1
+        done = lanes  # дорожки, на которых инструкция исполнена
+        if op == Opcodes.PUSH:
+            sp[lanes] -= 1
+            mem[lanes, self.address(sp[lanes])] = crop32(ac[lanes])
+        elif op == Opcodes.POP:
+            ac[lanes] = mem[lanes, self.address(sp[lanes])]
+            sp[lanes] += 1
+        elif op == Opcodes.LD:
+            if mode == 0:
+                ac[lanes] = v
+            elif mode == 1:
+                ac[lanes] = mem[lanes, v % self.size]
+            else:
+                dr = mem[lanes, self.address(sp[lanes] + v)]
+                if mode == 3:
+                    dr = mem[lanes, self.address(dr)]
+                ac[lanes] = dr
+        elif op == Opcodes.ST:
+            if mode == 0:
+                ar = np.full(len(lanes), v, dtype=np.int64)
+            elif mode == 1:
+                ar = mem[lanes, v % self.size]
+            else:
+                ar = crop32(sp[lanes] + v)
+                if mode == 3:
+                    ar = mem[lanes, ar % self.size]
+            mem[lanes, ar % self.size] = crop32(ac[lanes])
+        elif op in machine.alu_opcodes:
+            if mode == 0:
+                right = np.full(len(lanes), v, dtype=np.int64)
+            elif mode == 1:
+                right = mem[lanes, v % self.size]
+            else:
+                right = mem[lanes, self.address(sp[lanes] + v)]
+            left = ac[lanes]
+            if op in (Opcodes.DIV, Opcodes.MOD):
+                zero = right == 0
+                if zero.any():
+                    faulted = lanes[zero]
+                    # DataPath останавливается до последнего такта DIV n
+                    tick[faulted] += machine.instruction_ticks[(op, mode)] - (mode == 0)
+                    self.ip[faulted] += 1
+                    self.stop(faulted, StopReasons.FAULT, "/0" if op == Opcodes.DIV else "%0")
+                    lanes, ip, left, right = lanes[~zero], ip[~zero], left[~zero], right[~zero]
+                    done = lanes
+                safe = np.where(right == 0, 1, right)
+                res = left // safe if op == Opcodes.DIV else left % safe
+            elif op in (Opcodes.SUB, Opcodes.CMP):
+                res = left - right
+            elif op == Opcodes.ADD:
+                res = left + right
+            else:
+                res = left * right
+            self.z[lanes] = res == 0
+            self.s[lanes] = res < 0
+            if op != Opcodes.CMP:
+                ac[lanes] = crop32(res)
+        elif op in (Opcodes.JE, Opcodes.JNE, Opcodes.JGE):
+            if op == Opcodes.JE:
+                taken = self.z[lanes]
+            elif op == Opcodes.JNE:
+                taken = ~self.z[lanes]
+            else:
+                taken = ~self.s[lanes]
+            ip = np.where(taken, v, ip)
+        elif op == Opcodes.JMP:
+            ip = np.full(len(lanes), v, dtype=np.int64)
+        elif op == Opcodes.CALL:
+            sp[lanes] -= 1
+            mem[lanes, self.address(sp[lanes])] = ip
+            ip = np.full(len(lanes), v, dtype=np.int64)
+        elif op == Opcodes.RET:
+            ip = mem[lanes, self.address(sp[lanes])]
+            sp[lanes] += 1
+        elif op == Opcodes.OUT:
+            for lane, value in zip(lanes.tolist(), ac[lanes].tolist()):
+                self.output[lane].write(value)
+        elif op == Opcodes.IN:
+            starved = self.input_position[lanes] >= self.input_size[lanes]
+            if starved.any():
+                tick[lanes[starved]] += 1
+                self.stop(lanes[starved], StopReasons.INPUT_STARVED)
+                lanes, ip = lanes[~starved], ip[~starved]
+                done = lanes
+            ac[lanes] = self.input[lanes, self.input_position[lanes]]
+            self.input_position[lanes] += 1
+        elif op == Opcodes.HALT:  # и недопустимые режимы адресации, см. FastEngine.normalize
+            tick[lanes] += 1
+            self.ip[lanes] = ip
+            self.stop(lanes, v)
+            return
+        tick[done] += machine.instruction_ticks.get((op, mode), 1)
+        self.ip[done] = ip
+        self.instructions[done] += 1
+
+    def results(self):
+        """`(output, instr_counter, ticks)` каждой дорожки, как у `machine.simulation`."""
+        return [
+            (port.getvalue(), instructions, ticks)
+            for port, instructions, ticks in zip(self.output, self.instructions.tolist(), self.ticks.tolist())
+        ]
+
+
+def simulate_lanes(code, inputs, data_memory_size=1000, limit=1500):
+    """Исполнить `code` на каждом входе из `inputs` (строки); результаты -- как у `machine.simulation`."""
+    engine = VectorEngine(code, [[ord(char) for char in text] + [0] for text in inputs], data_memory_size)
+    engine.run(limit)
+    return engine.results()
+
+
+if __name__ == "__main__":
+    assert len(sys.argv) in (3, 4), "Wrong arguments: vector.py <code_file> <inputs_file> [limit]"
+    _, code_file, inputs_file, *limit = sys.argv
+    with open(inputs_file, encoding="utf-8") as f:
+        inputs = [json.loads(line) for line in f if line.strip()]  # строки JSON -- ввод каждой дорожки
+    for output, instr_counter, ticks in simulate_lanes(
+        machine.read_code(code_file), inputs, limit=int(limit[0]) if limit else 1500
+    ):
+        print(json.dumps({"output": output, "instr_counter": instr_counter, "ticks": ticks}, ensure_ascii=False))